@@ -1,26 +1,28 @@
 '''This is better, running all downloads for each chapter concurrently.
 But the way this loop works is inefficient because at every chapter it needs to run a sync request to update a variable'''
 # from decorators import ResponseTimer
+from extractors import extractors, ExtractionError
+from storage import write_stream
+from manifest import Manifest
+from limiter import AdaptiveLimiter
+from retry import RetryPolicy
+from session import SessionFactory
 from urllib.parse import urlparse
-from bs4 import BeautifulSoup
 from time import strftime, perf_counter
 import argparse
 import requests
 import shutil
-import glob
 import os
 import sys
 import json
 
-from aiohttp import ClientSession
 import asyncio
-import aiofiles
 
 
 class Scraper:
     'Async implementation for downloading multiple images concurrently'
     def __init__(self):
-        self.base_url = 'https://www.mangareader.net/naruto/'
+        self.base_url = f"{os.environ.get('MANGAREADER_URL', 'https://www.mangareader.net')}/naruto/"
         self.base_path = os.path.join(os.getcwd(), 'Naruto')
 
         parser = argparse.ArgumentParser()
@@ -31,13 +33,18 @@ class Scraper:
         args = parser.parse_args()
 
         self.debug = args.debug
+        self.extractor = extractors['auto']
         self.write_to_file = args.download
+        self.manifest = Manifest(self.base_path)
+        self.limiter = AdaptiveLimiter(urlparse(self.base_url).netloc, {'maximum': 30}, {'maximum': 60})
+        self.retry = RetryPolicy()
         self.initial = self.last_chapter
         self.runtime_pages = 0
         self.current_chapter = self.initial
         self.current_page = self.last_page
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:74.0) Gecko/20100101 Firefox/74.0'}
+        self.sessions = SessionFactory(self.headers)
         # if self.debug:
         #     requests.get = ResponseTimer(requests.get)
         # creating asyncio event loop
@@ -49,6 +56,10 @@ class Scraper:
         except Exception as e:
             print(e)
         finally:
+            self.loop.run_until_complete(self.sessions.close())
+            print(f"Connections: {self.sessions.stats}, reuse ratio {self.sessions.reuse_ratio:.2f}")
+            for failure in self.retry.failures:
+                print(f"Failed: {failure}")
             print(f"Total duration of requests of {self.runtime_pages} pages from Chapter {self.initial} to {self.last_chapter}: {(perf_counter() - self.start):.2f} seconds")
 
 
@@ -59,14 +70,13 @@ class Scraper:
         while True:
             # try:
             start = perf_counter()
-            async with asyncio.Semaphore(60):
-                all_endpoints = (f'{self.current_chapter_endpoint}{page}' for page in range(
-                    self.current_page, self.total_pages + 1))
-                tasks = []
-                async with ClientSession(headers=self.headers) as session:
-                    for endpoint in all_endpoints:
-                        tasks.append(self.fetch(session, endpoint))
-                    await asyncio.gather(*tasks)
+            all_endpoints = (f'{self.current_chapter_endpoint}{page}' for page in range(
+                self.current_page, self.total_pages + 1))
+            tasks = []
+            session = self.sessions.session()
+            for endpoint in all_endpoints:
+                tasks.append(self.fetch(session, endpoint))
+            await asyncio.gather(*tasks)
 
 
             print(f"Chapter {self.current_chapter} finished in: {(perf_counter() - start):.2f} seconds")
@@ -78,30 +88,34 @@ class Scraper:
             #     break
 
     async def fetch(self, session, url):
-        '''Makes async http requests and parses it with bs4
+        '''Fetches the page at url and its image, retrying failures with self.retry'''
+        await self.retry.call(url, self.fetch_page, session, url)
+
+    async def fetch_page(self, session, url):
+        '''Makes async http requests and parses it with self.extractor
         Download's the image that the first endpoint matched'''
-        try:
+        async with self.limiter.request(url) as slot:
             async with session.get(url) as response:
+                slot.response(response.status)
+                response.raise_for_status()
                 if self.debug:
                     print(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {response.status}@{response.url.path!r}")
                 page_number = os.path.splitext(url)[0].split('/')[-1]
                 chapter = os.path.splitext(url)[0].split('/')[-2]
                 directory = f"Chapter {chapter}"
                 html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                img_url = soup.findAll("div", attrs={"id": "imgholder"})[0].img["src"]
-                async with session.get(img_url) as response:
-                    print(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {response.status}@{response.url.path!r}")
-                    photo = f'Boruto.ch{chapter}.p{page_number.zfill(3)}.jpg'
-                    photo_path = os.path.join(self.base_path, directory, photo)
-                    if not self.debug:
-                        print(f'Creating {photo_path}')
-                    async with aiofiles.open(photo_path, 'wb') as aiof:
-                        await aiof.write(await response.read())
-                        await aiof.close()
-        except Exception as e:
-            print(e)
-            await self.fetch(session, url)
+                img_url = self.extractor.image_url(html)
+        async with self.limiter.request(img_url) as slot:
+            async with session.get(img_url) as response:
+                slot.response(response.status)
+                response.raise_for_status()
+                print(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {response.status}@{response.url.path!r}")
+                photo = f'Boruto.ch{chapter}.p{page_number.zfill(3)}.jpg'
+                photo_path = os.path.join(self.base_path, directory, photo)
+                if not self.debug:
+                    print(f'Creating {photo_path}')
+                size = await write_stream(response, photo_path)
+                self.manifest.add_page(int(chapter), int(page_number), size, img_url)
 
     @property
     def current_chapter_endpoint(self):
@@ -109,32 +123,11 @@ class Scraper:
 
     @property
     def last_chapter(self):
-        paths = glob.glob(os.path.join(self.base_path, '*/'))
-        chapter_list = []
-        if paths:
-            for chapter in paths:
-                chapter_dir = chapter.split(os.path.sep)[-2]
-                chapter_number = chapter_dir.strip('Chapter ')
-                chapter_list.append(int(chapter_number))
-            return max(chapter_list)
-        else:
-            return 1
+        return self.manifest.last_chapter
 
     @property
     def last_page(self):
-        path = os.path.join(
-            self.base_path, f'Chapter {self.current_chapter}', "*.jpg")
-        paths = glob.glob(path)
-        image_list = []
-        if paths:
-            for image in paths:
-                image_file = image.split(os.path.sep)[-1]
-                image_name = os.path.splitext(image_file)[0]
-                image_number = int(image_name[(len(image_name) - 2):])
-                image_list.append(image_number)
-            return max(image_list)
-        else:
-            return 1
+        return self.manifest.last_page(self.current_chapter)
 
     async def reset(self):
         'resets pages to 1 and increments chapter by 1'
@@ -159,21 +152,18 @@ class Scraper:
         '''Updates the total_pages variable given the current chapter.
         If the current page == total_pages: increments current chapter and calls itself.'''
         try:
-            async with ClientSession(headers=self.headers) as session:
-                async with session.get(f"{self.current_chapter_endpoint}{self.last_page}") as response:
-                    print(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {response.status}@{response.url.path!r}")
-                    if response.status == 200:
-                        soup = BeautifulSoup(await response.text(), 'html.parser')
-                        pages_in_chapter = soup.findAll(
-                            'div', {'id': 'selectpage'})[0].text
-                        self.total_pages = int(
-                            pages_in_chapter[(len(pages_in_chapter)-2):])
-                        self.runtime_pages += self.total_pages
-                        if self.current_page == self.total_pages:
-                            await self.reset()
-                    else:
-                        response.raise_for_status()
-        except IndexError:
+            session = self.sessions.session()
+            async with session.get(f"{self.current_chapter_endpoint}{self.last_page}") as response:
+                print(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {response.status}@{response.url.path!r}")
+                if response.status == 200:
+                    self.total_pages = self.extractor.total_pages(await response.text())
+                    self.manifest.set_pages(self.current_chapter, self.total_pages)
+                    self.runtime_pages += self.total_pages
+                    if self.current_page == self.total_pages:
+                        await self.reset()
+                else:
+                    response.raise_for_status()
+        except ExtractionError:
             print('No new chapters yet, check again at 20th of every month')
             sys.exit()
 
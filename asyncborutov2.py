@@ -1,241 +1,291 @@
 '''This is as better as I could improve the task concurrency by running all initial requests concurrently
 and passing their state to the download function.
-Also added a search query for cmdline input, or a hardcoded preset, to prevent the extra sync request'''
-from urllib.parse import urlparse, urlencode
-from time import strftime, perf_counter
-from decorators import ResponseTimer
-from formatters import char_remover
-from collections import namedtuple
-from bs4 import BeautifulSoup
-from fuzzywuzzy import fuzz
+Also added a search query for cmdline input, or a hardcoded preset, to prevent the extra sync request.
+The scraping itself lives in client.MangaClient, this is its command line.
+Modules only some runs need (bs4, fuzzywuzzy, aiohttp, Pillow...) are imported where they're used,
+so a run that finds nothing new starts fast, see benchmarks/bench_startup.py'''
+from time import perf_counter
+from extractors import extractors
+from storage import storages
+from cache import DEFAULT_TTLS
+from client import MangaClient, PRESETS
+from scheduler import POLICIES
+from watch import Watcher
 import argparse
-import requests
-import shutil
 import glob
 import os
-import sys
 import json
 
-from aiohttp import ClientSession
 import asyncio
-import aiofiles
 
 
 class Scraper:
-    '''Async scraper and parser to download manga chapters from mangareader.net'''
-    def __init__(self):
-        presets = {
-            'boruto': {
-                'directory': 'Boruto Naruto Next Generations',
-                'endpoint': '/boruto-naruto-next-generations',
-                'creator': 'KODACHI Ukyo',
-                'image_name': 'Boruto'
-            },
-            'naruto': {
-                'directory': 'Naruto',
-                'endpoint': '/naruto',
-                'creator': 'KISHIMOTO Masashi',
-                'image_name': 'Naruto'
-            }
-        }
+    '''Command line front end of client.MangaClient, downloading one or more series to --path'''
+    def __init__(self, argv=None):
         parser = argparse.ArgumentParser()
-        group = parser.add_mutually_exclusive_group(required=True)
+        group = parser.add_mutually_exclusive_group()
         group.add_argument('--search', '-s', action='store', help='search manga in mangareader.net')
-        group.add_argument('--preset', '-p', type=str, choices=presets)
+        group.add_argument('--preset', '-p', type=str, nargs='+', choices=PRESETS,
+                           help='one or more presets, downloaded together sharing one connection pool')
+        group.add_argument('--config', '-c', dest='config', action='store',
+                           help='json file with a list of preset names or '
+                                '{"directory", "endpoint", "image_name"} objects to download together')
         parser.add_argument('--path', dest='path', action='store', default=os.getcwd(), help='path to save files')
+        parser.add_argument('--pick', dest='pick', choices=('ask', 'best'), default='ask',
+                            help='with --search, ask which match to download or take the best one without asking')
+        parser.add_argument('--catalog', dest='catalog', default=None,
+                            help='json file caching every series for --search, defaults to catalog.json in --path')
+        parser.add_argument('--catalog-ttl', dest='catalog_ttl', type=int, default=7 * 24 * 3600,
+                            help='seconds before the catalog is refreshed from mangareader, 0 to refresh now')
         parser.add_argument('--debug', '-d', dest='debug', default=False,
-                            action='store_true', help='display information of get requests')
+                            action='store_true', help='log every request with its status and duration, even with --quiet')
         parser.add_argument('--no-download', '-n', dest='download', default=True,
                             action='store_false', help='weather or not to download')
-        args = parser.parse_args()
+        parser.add_argument('--quiet', '-q', dest='quiet', default=False, action='store_true',
+                            help="don't print a line per request or directory, only errors and the summary")
+        parser.add_argument('--watch', '-w', dest='watch', default=False, action='store_true',
+                            help='keep running, polling every series for new chapters instead of exiting')
+        parser.add_argument('--interval', dest='interval', type=float, default=3600,
+                            help='with --watch, seconds between polls of each series')
+        parser.add_argument('--jitter', dest='jitter', type=float, default=0.1,
+                            help='with --watch, random +- fraction of --interval added to each poll')
+        parser.add_argument('--max-backoff', dest='max_backoff', type=float, default=24 * 3600,
+                            help='with --watch, max seconds between polls of a series whose polls fail')
+        parser.add_argument('--status-port', dest='status_port', type=int, default=None,
+                            help='with --watch, serve /health, /status and the prometheus metrics on this port')
+        parser.add_argument('--coordinator', dest='coordinator', default=None, metavar='QUEUE',
+                            help='publish the pending chapters to the sqlite job queue QUEUE for --worker processes '
+                                 'and report on them until every job is done')
+        parser.add_argument('--no-wait', dest='wait', default=True, action='store_false',
+                            help='with --coordinator, exit once the chapters are published')
+        parser.add_argument('--worker', dest='worker', default=None, metavar='QUEUE',
+                            help='download the jobs of the sqlite job queue QUEUE into --path (shared with the '
+                                 'coordinator) until it is empty, --image-workers jobs at a time')
+        parser.add_argument('--lease', dest='lease', type=float, default=300,
+                            help='seconds a worker holds a job before it goes back to the queue')
+        parser.add_argument('--job-attempts', dest='job_attempts', type=int, default=3,
+                            help='leases of a job before it is recorded as failed')
+        parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=None,
+                            help='serve prometheus metrics on this port while running')
+        parser.add_argument('--metrics-host', dest='metrics_host', default='127.0.0.1',
+                            help='address --metrics-port and --status-port listen on, 0.0.0.0 for every interface')
+        parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                            help='periodically write a json snapshot of the metrics to this file')
+        parser.add_argument('--metrics-interval', dest='metrics_interval', type=float, default=10,
+                            help='seconds between --metrics-file snapshots')
+        parser.add_argument('--chapter-workers', dest='chapter_workers', type=int, default=5,
+                            help='number of workers discovering the pages of each chapter')
+        parser.add_argument('--page-workers', dest='page_workers', type=int, default=25,
+                            help='number of workers parsing page html for image urls')
+        parser.add_argument('--image-workers', dest='image_workers', type=int, default=25,
+                            help='number of workers downloading images')
+        parser.add_argument('--schedule', dest='schedule', choices=POLICIES, default='round-robin',
+                            help='order of the download queues: round robin between series, the newest chapters '
+                                 'first, or the chapters in flight first')
+        parser.add_argument('--queue-size', dest='queue_size', type=int, default=100,
+                            help='max items waiting between pipeline stages')
+        parser.add_argument('--extractor', '-e', dest='extractor', choices=extractors, default='auto',
+                            help='how to extract image urls and page counts from page html')
+        parser.add_argument('--parse-processes', dest='parse_processes', type=int, default=0,
+                            help='parse html in a pool of this many processes instead of on the event loop, 0 to parse inline')
+        parser.add_argument('--storage', dest='storage', choices=storages, default='directory',
+                            help='save each chapter as a directory of jpgs or as a single cbz archive')
+        parser.add_argument('--dedup', dest='dedup', default=None, nargs='?', const='', metavar='STORE',
+                            help='keep one copy of every distinct image in STORE (blobs in --path by default), '
+                                 'hardlinked from each chapter directory')
+        parser.add_argument('--transform', dest='transform', choices=('webp', 'avif', 'jpeg'), default=None,
+                            help='re-encode every image to this format before storing it, needs Pillow')
+        parser.add_argument('--quality', dest='quality', type=int, default=80, help='--transform encoder quality')
+        parser.add_argument('--max-size', dest='max_size', default=None, metavar='WIDTHxHEIGHT',
+                            help='with --transform, shrink images to fit this size')
+        parser.add_argument('--thumbnail', dest='thumbnail', default=None, metavar='WIDTHxHEIGHT',
+                            help='with --transform, also save a thumbnail of this size under Thumbnails/')
+        parser.add_argument('--transform-processes', dest='transform_processes', type=int, default=None,
+                            help='processes transforming images, the cpu count by default')
+        parser.add_argument('--skip-existing', dest='skip_existing', default=False, action='store_true',
+                            help='work out the missing pages from the manifest and disk before any request')
+        parser.add_argument('--validate', dest='validate', default=False, action='store_true',
+                            help='with --skip-existing, refetch pages whose size or jpeg trailer is wrong')
+        parser.add_argument('--cache', dest='cache', default=None,
+                            help='sqlite file caching html responses, defaults to http_cache.sqlite in --path')
+        parser.add_argument('--no-cache', dest='use_cache', default=True, action='store_false',
+                            help='send every html request upstream')
+        parser.add_argument('--cache-ttl', dest='cache_ttl', action='append', default=[], metavar='CLASS=SECONDS',
+                            help=f'seconds a cached response is used without revalidation, classes: {", ".join(DEFAULT_TTLS)}')
+        parser.add_argument('--cache-size', dest='cache_size', type=int, default=64,
+                            help='max size of the html cache in MB')
+        parser.add_argument('--retries', dest='retries', type=int, default=5,
+                            help='attempts per url before it is written to error.log')
+        parser.add_argument('--html-limit', dest='html_limit', type=int, default=20,
+                            help='max concurrent requests to mangareader.net, adapted down on errors and slowdowns')
+        parser.add_argument('--image-limit', dest='image_limit', type=int, default=50,
+                            help='max concurrent requests to each image host, adapted down on errors and slowdowns')
+        parser.add_argument('--connections', dest='connections', type=int, default=100,
+                            help='max open connections in the shared connection pool')
+        parser.add_argument('--connections-per-host', dest='connections_per_host', type=int, default=0,
+                            help='max open connections per host, 0 for no limit')
+        parser.add_argument('--dns-ttl', dest='dns_ttl', type=int, default=300,
+                            help='seconds dns lookups are cached')
+        parser.add_argument('--keepalive', dest='keepalive', type=float, default=30,
+                            help='seconds idle connections are kept open for reuse')
+        args = parser.parse_args(argv)
+        if not (args.search or args.preset or args.config or args.worker):
+            parser.error('one of the arguments --search/-s --preset/-p --config/-c or --worker is required')
+        if args.worker and (args.search or args.preset or args.config or args.coordinator or args.watch):
+            parser.error('--worker takes its series from the job queue')
+        if (args.worker or args.coordinator) and args.storage != 'directory':
+            parser.error('--coordinator and --worker need --storage directory, workers write pages of the same chapter')
+        if args.dedup is not None and args.storage != 'directory':
+            parser.error('--dedup needs --storage directory, cbz archives are self contained')
+        self.args = args
         self.write_to_file = args.download
         self.debug = args.debug
+        self.quiet = args.quiet
+        self.metrics_port = args.metrics_port
+        self.metrics_file = args.metrics_file
+        self.metrics_interval = args.metrics_interval
         self.path = args.path
-        if self.debug:
-            requests.get = ResponseTimer(requests.get)
+        self.pick = args.pick
+        ttls = {name: int(seconds) for name, seconds in (ttl.split('=') for ttl in args.cache_ttl)}
+        transformer = None
+        if args.transform:
+            # Pillow is only needed with --transform
+            from transform import Transformer, size
+            transformer = Transformer(args.transform, args.quality, args.max_size and size(args.max_size),
+                                      args.thumbnail and size(args.thumbnail), args.transform_processes)
+        self.client = MangaClient(
+            path=self.path,
+            extractor=args.extractor,
+            parse_processes=args.parse_processes,
+            storage=args.storage,
+            dedup=(args.dedup or os.path.join(self.path, 'blobs')) if args.dedup is not None else None,
+            cache=(args.cache or os.path.join(self.path, 'http_cache.sqlite')) if args.use_cache else None,
+            cache_ttls=ttls,
+            cache_size=args.cache_size * 1024 * 1024,
+            retries=args.retries,
+            html_limit=args.html_limit,
+            image_limit=args.image_limit,
+            connections=args.connections,
+            connections_per_host=args.connections_per_host,
+            dns_ttl=args.dns_ttl,
+            keepalive=args.keepalive,
+            catalog=args.catalog or os.path.join(self.path, 'catalog.json'),
+            catalog_ttl=args.catalog_ttl,
+            chapter_workers=args.chapter_workers,
+            page_workers=args.page_workers,
+            image_workers=args.image_workers,
+            queue_size=args.queue_size,
+            skip_existing=args.skip_existing,
+            validate=args.validate,
+            transform=transformer,
+            schedule=args.schedule,
+            log=print if self.debug or not self.quiet else None)
+        self.series = []
 
-        if args.preset:
-            preset = presets[args.preset]
-            self.directory = preset['directory']
-            self.base_endpoint = preset['endpoint']
-            self.creator = preset['creator']
-            self.image_name = preset['image_name']
-            self.base_path = os.path.join(self.path, self.directory)
-            if not os.path.isdir(self.base_path):
-                os.mkdir(self.base_path)
-        else:
-            self.match(args.search)
-
-        self.base_url = 'https://www.mangareader.net'
-        self.manga_url = f"{self.base_url}{self.base_endpoint}"
-        self.initial = self.last_chapter
-        self.runtime_pages = 0
-        self.errors = []
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:74.0) Gecko/20100101 Firefox/74.0'}
+    def run(self):
+        '''Downloads the series of the command line, printing a summary at the end'''
+        client = self.client
         # creating asyncio event loop
+        self.loop = asyncio.get_event_loop()
+        if self.args.preset:
+            self.series = [client.series(preset) for preset in self.args.preset]
+        elif self.args.config:
+            with open(self.args.config) as config:
+                self.series = [client.series(entry) for entry in json.load(config)]
+        elif self.args.search:
+            self.series = [self.loop.run_until_complete(self.match(self.args.search))]
+
         try:
             self.start = perf_counter()
-            self.loop = asyncio.get_event_loop()
             self.loop.run_until_complete(self.main())
         except Exception as e:
             print(e)
         finally:
-            print(f"Total duration of requests of {self.runtime_pages} pages from Chapter {self.initial} to {self.last_chapter}: {(perf_counter() - self.start):.2f} seconds")
-            with open(os.path.join(self.base_path, 'error.log'), 'a') as errorlog:
-                error_obj = {"missing chapters": self.errors}
-                json.dump(error_obj, errorlog)
-
-    @property
-    def end_chapter(self):
-        '''Makes a request to self.manga_url to get the last chapter available'''
-        with requests.get(self.manga_url) as response:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            last_a = soup.findAll('ul')[2].findAll('a')[0]['href']
-            return int(last_a.split('/')[-1])
-
-    @property
-    def last_chapter(self):
-        '''Gets the last chapter created'''
-        paths = glob.glob(os.path.join(self.base_path, '*/'))
-        chapter_list = []
-        if paths:
-            for chapter in paths:
-                chapter_dir = chapter.split(os.path.sep)[-2]
-                chapter_number = chapter_dir.strip('Chapter ')
-                chapter_list.append(int(chapter_number))
-            return max(chapter_list)
-        else:
-            return 1
-
-    def match(self, string):
-        payload = urlencode({"q": string.lower(), "limit": 100})
-        with requests.get("https://mangareader.net/actions/search/?", params=payload) as response:
-            if response.ok:
-                data = response.text.split('\n')
-                Fields = namedtuple('Fields', ['Name', 'Image', 'Title', 'Creator', 'Endpoint', 'Index'])
-                match_list = []
-                for match in data:
-                    if match:
-                        fields = Fields(*match.split('|'))
-                        rating = fuzz.ratio(fields.Name.lower(), string.lower())
-                        obj = {'rating': rating, 'obj': fields}
-                        match_list.append(obj)
-                best_match = max([match['rating'] for match in match_list])
-                best_tuple = [match['obj'] for match in match_list if match['rating'] == best_match]
-                for index, tup in enumerate(best_tuple):
-                    print(f"[{index}] {tup.Name} by {tup.Creator} @ {tup.Endpoint!r}")
-                chosen = char_remover(best_tuple[int(input('Choose index: '))])
-                if chosen.Name not in glob.glob(os.path.join(self.path, "*/")):
-                    directory = input(f"default = {chosen.Name}\nDirectory to save to: ")
-                    if directory:
-                        self.directory = directory
-                    else:
-                        self.directory = chosen.Name
-                else:
-                    self.directory = chosen.Name
-                self.base_endpoint = chosen.Endpoint
-                self.base_path = os.path.join(self.path, self.directory)
-                if not os.path.isdir(self.base_path):
-                    os.mkdir(self.base_path)
-                self.image_name = char_remover(chosen.Name.split(" ")[0])
+            snapshot = client.metrics.snapshot()
+            for stage, stats in snapshot['stages'].items():
+                print(f"{stage}: {stats}")
+            for name in client.metrics.sources:
+                print(f"{name}: {snapshot[name]}")
+            print(f"Wrote {snapshot['bytes']} bytes at {snapshot['bytes_per_sec'] / 1024:.1f} KB/s")
+            for series in self.series:
+                print(f"{series.directory}: Total duration of requests of {series.runtime_pages} pages from Chapter {series.initial} to {series.last_chapter}: {(perf_counter() - self.start):.2f} seconds")
+            self.loop.run_until_complete(client.close())
 
-    async def main(self):
+    async def match(self, string):
         '''
-        In the first part creates tasks from the generator, which yields an endoint in range of
-        the last chapter and the end chapter.
-        When async.gather(*fetch_tasks) runs, returns a nested list of coroutines for each chapter
-        which is called when gathering download_tasks
+        Searches the catalog for string and asks which of the best matches to download
+        (or takes the best one with --pick best). Returns its Series
         '''
-        latest_chapter = self.end_chapter
-        if self.initial != latest_chapter:
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:74.0) Gecko/20100101 Firefox/74.0'}
-            fetch_tasks = []
-            sema_count = 50
-            self.sema = asyncio.Semaphore(sema_count)
-            async with ClientSession(headers=headers) as session:
-                for endpoint in (f"{self.manga_url}/{chapter}/1" for chapter in range(self.initial, latest_chapter + 1)):
-                    fetch_tasks.append(self.fetch(session, endpoint,))
-                download_tasks = await asyncio.gather(*fetch_tasks)
-                for task in download_tasks:
-                    await asyncio.gather(*task)
+        from formatters import char_remover
+        matches = await self.client.search(string)
+        if not matches:
+            raise LookupError(f"Nothing on mangareader matches {string!r}")
+        if self.pick == 'best':
+            chosen = char_remover(matches[0][1])
+            directory = chosen.Name
         else:
-            print('No new chapters yet, check again at 20th of every month')
+            for index, (rating, entry) in enumerate(matches):
+                print(f"[{index}] {entry.Name} by {entry.Creator} @ {entry.Endpoint!r} ({rating}%)")
+            chosen = char_remover(matches[int(input('Choose index: '))][1])
+            if chosen.Name not in glob.glob(os.path.join(self.path, "*/")):
+                directory = input(f"default = {chosen.Name}\nDirectory to save to: ")
+                if not directory:
+                    directory = chosen.Name
+            else:
+                directory = chosen.Name
+        image_name = char_remover(chosen.Name.split(" ")[0])
+        return self.client.series({'directory': directory, 'endpoint': chosen.Endpoint,
+                                   'image_name': image_name, 'creator': chosen.Creator})
 
-    async def fetch(self, session, url):
-        '''
-        Get request @ endpoint created by the generator in self.main, parsing response.text() with BeautifulSoup
-        Gets the total_pages for that chapter.
-        Returns a list of coroutines to be run in self.main() which will async download all images for each chapter in order of chapters
-        '''
-        start = perf_counter()
-        async with self.sema:
-            async with session.get(url) as response:
-                self.printer(response.status, response.url.path, start)
-                chapter = int(os.path.splitext(url)[0].split('/')[-2])
-                if response.status == 200:
-                    soup = BeautifulSoup(await response.text(), 'html.parser')
-                    pages_in_chapter = soup.findAll('div', {'id': 'selectpage'})[0].text
-                    await asyncio.sleep(0.25)
-                    total_pages = int(pages_in_chapter[(len(pages_in_chapter)-2):])
-                    tasks = []
-                    for endpoint in (f"{self.manga_url}/{chapter}/{page}" for page in range(1, total_pages + 1)):
-                        tasks.append(self.download(session, endpoint))
-                    return tasks
-
-                elif response.status == 404:
-                    self.errors.append(url)
-                    return []
-
-                else:
-                    response.raise_for_status()
-
-    async def download(self, session, url):
+    async def main(self):
         '''
-        Makes async http requests and parses it with BeautifulSoup
-        Download's the image that the first endpoint matched.
-        If request fails, retries it in the excepion catch
+        Runs client.download over every series, a Watcher over them with --watch,
+        or the Coordinator or Worker of a distributed run, with the metrics reporters asked for on the command line
         '''
-        async with self.sema:
-            try:
-                start = perf_counter()
-                async with session.get(url) as response:
-                    self.printer(response.status, response.url.path, start)
-                    page_number = os.path.splitext(url)[0].split('/')[-1]
-                    chapter = os.path.splitext(url)[0].split('/')[-2]
-                    directory = f"Chapter {chapter}"
-                    await self.mkdir(chapter)
-
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'html.parser')
-                    img_url = soup.findAll("div", attrs={"id": "imgholder"})[
-                        0].img["src"]
-                    await asyncio.sleep(0.25)
-                    start = perf_counter()
-                    async with session.get(img_url) as response:
-                        self.printer(response.status, response.url.path, start)
-                        photo = f'{self.image_name}.ch{chapter}.p{page_number.zfill(3)}.jpg'
-                        photo_path = os.path.join(self.base_path, directory, photo)
-                        async with aiofiles.open(photo_path, 'wb') as aiof:
-                            await aiof.write(await response.read())
-                            await aiof.close()
-                        self.runtime_pages += 1
-            except Exception as e:
-                print(e)
-                await self.download(session, url)
+        metrics = self.client.metrics
+        reporters = []
+        watcher = None
+        if self.args.watch:
+            watcher = Watcher(self.client, self.series, self.args.interval, self.args.jitter, self.args.max_backoff)
+            if self.args.status_port:
+                reporters.append(asyncio.ensure_future(metrics.serve(self.args.status_port, self.args.metrics_host,
+                                                                         routes=watcher.routes())))
+        if self.metrics_port:
+            reporters.append(asyncio.ensure_future(metrics.serve(self.metrics_port, self.args.metrics_host)))
+        if self.metrics_file:
+            reporters.append(asyncio.ensure_future(metrics.write_snapshots(self.metrics_file, self.metrics_interval)))
+        try:
+            if watcher:
+                await watcher.run()
+            elif self.args.coordinator or self.args.worker:
+                await self.distributed()
+            else:
+                results = await self.client.download(*self.series)
+                for directory, chapters in results.items():
+                    if isinstance(chapters, Exception):
+                        print(f'{directory}: skipped, {chapters}')
+                    elif not chapters:
+                        print(f'{directory}: No new chapters yet, check again at 20th of every month')
+        finally:
+            for reporter in reporters:
+                reporter.cancel()
+            await asyncio.gather(*reporters, return_exceptions=True)
 
-    async def mkdir(self, chapter):
-        '''Checks if there is a directory for the current chapter.
-        If not, creates it.'''
-        directory = os.path.join(self.base_path, f'Chapter {chapter}')
-        if not os.path.isdir(directory):
-            if not self.debug:
-                print(f"Creating directory {directory}")
-            os.mkdir(directory)
+    async def distributed(self):
+        '''Runs this process as the coordinator or a worker of the job queue'''
+        from distributed import Coordinator, Worker
+        from jobqueue import JobQueue
+        queue = JobQueue(self.args.coordinator or self.args.worker, self.args.lease, self.args.job_attempts)
+        try:
+            if self.args.coordinator:
+                await Coordinator(self.client, queue).run(self.series, self.args.wait)
+            else:
+                worker = Worker(self.client, queue, self.args.image_workers)
+                await worker.run()
+                self.series = list(worker.series.values())
+        finally:
+            queue.close()
 
-    def printer(self, status, url_path, start):
-        '''Wraps the async response with usefull debugging stats'''
-        print(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {status}@{url_path!r} finished in {(perf_counter() - start):.2f}")
 
 if __name__ == "__main__":
-    Scraper()
+    Scraper().run()
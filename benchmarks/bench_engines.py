@@ -0,0 +1,124 @@
+'''Runs each scraper engine against benchmarks/stub_server.py and reports pages/sec, server side p50/p99
+request latency, peak RSS and CPU time of the engine process, without touching the network.
+Every engine runs in its own process in a fresh temporary directory, with MANGAREADER_URL pointed at the stub.
+Usage: python benchmarks/bench_engines.py [--engines boruto asyncboruto asyncborutov2] [--latency 0.05] [--json out.json]'''
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from stub_server import StubServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# script, extra arguments and the directory the engine expects to exist under its working directory
+ENGINES = {
+    'boruto': ('boruto.py', [], 'Boruto'),
+    'asyncboruto': ('asyncboruto.py', [], 'Naruto'),
+    'asyncborutov2': ('asyncborutov2.py', ['--preset', 'naruto', '--no-cache', '--quiet'], None),
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StubThread:
+    '''Runs a StubServer on its own event loop in a daemon thread'''
+
+    def __init__(self, **options):
+        self.stub = StubServer(**options)
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.stub.start())
+        self.ready.set()
+        self.loop.run_forever()
+
+    def reset(self):
+        self.stub.latencies.clear()
+        self.stub.counts.clear()
+
+
+def run_engine(name, stub, timeout):
+    '''Runs engine name to completion against stub, returning its measurements'''
+    script, extra, directory = ENGINES[name]
+    stub.reset()
+    with tempfile.TemporaryDirectory() as cwd:
+        if directory:
+            os.mkdir(os.path.join(cwd, directory))
+        args = [sys.executable, os.path.join(ROOT, script)] + extra
+        if name == 'asyncborutov2':
+            args += ['--path', cwd]
+        env = dict(os.environ, MANGAREADER_URL=stub.stub.url,
+                   PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+        start = perf_counter()
+        process = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        _, status, usage = os.wait4(process.pid, 0)
+        timer.cancel()
+        wall = perf_counter() - start
+        stderr = process.stderr.read().decode(errors='replace').strip()
+        process.stderr.close()
+        pages = sum(1 for _, _, files in os.walk(cwd) for file in files if file.endswith('.jpg'))
+    latencies = [latency for values in stub.stub.latencies.values() for latency in values]
+    # ru_maxrss is in KB on linux and bytes on macOS
+    rss = usage.ru_maxrss / 1024 if sys.platform != 'darwin' else usage.ru_maxrss / 1024 / 1024
+    return {
+        'engine': name,
+        'exit_status': os.waitstatus_to_exitcode(status),
+        'pages': pages,
+        'wall_seconds': round(wall, 3),
+        'pages_per_sec': round(pages / wall, 2) if wall else None,
+        'p50_latency': percentile(latencies, 0.5),
+        'p99_latency': percentile(latencies, 0.99),
+        'requests': {f"{kind} {code}": count for (kind, code), count in sorted(stub.stub.counts.items())},
+        'peak_rss_mb': round(rss, 1),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        'stderr_tail': stderr[-500:],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--chapters', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--image-size', type=int, default=200 * 1024)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before an engine is killed')
+    parser.add_argument('--json', dest='json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    stub = StubThread(chapters=args.chapters, pages=args.pages, image_size=args.image_size,
+                      latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    print(f"{args.chapters} chapters x {args.pages} pages of {args.image_size} bytes, "
+          f"latency {args.latency}s +- {args.jitter}s, error rate {args.error_rate}")
+    results = []
+    for engine in args.engines:
+        result = run_engine(engine, stub, args.timeout)
+        results.append(result)
+        p50 = f"{result['p50_latency'] * 1000:.1f}ms" if result['p50_latency'] is not None else '-'
+        p99 = f"{result['p99_latency'] * 1000:.1f}ms" if result['p99_latency'] is not None else '-'
+        print(f"{engine:>14}: {result['pages']:4} pages in {result['wall_seconds']:7.2f}s "
+              f"{result['pages_per_sec']:8.2f} pages/s  p50 {p50:>8} p99 {p99:>8}  "
+              f"rss {result['peak_rss_mb']:6.1f}MB  cpu {result['cpu_seconds']:6.2f}s  exit {result['exit_status']}")
+        if result['exit_status'] != 0 or not result['pages']:
+            print(f"{'':>16}{result['stderr_tail']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
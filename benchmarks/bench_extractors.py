@@ -0,0 +1,49 @@
+'''Micro-benchmark of the html extractors against saved mangareader pages.
+Usage: python benchmarks/bench_extractors.py [--number N] [fixture.html ...]
+Defaults to every .html file in benchmarks/fixtures'''
+from time import perf_counter
+import argparse
+import glob
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extractors import extractors
+
+
+def bench(extractor, html, number):
+    '''Returns the mean seconds per call of image_url and total_pages'''
+    results = {}
+    for method in ('image_url', 'total_pages'):
+        func = getattr(extractor, method)
+        start = perf_counter()
+        for _ in range(number):
+            func(html)
+        results[method] = (perf_counter() - start) / number
+    return results
+
+
+if __name__ == '__main__':
+    fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fixtures', nargs='*', default=sorted(glob.glob(os.path.join(fixtures_dir, '*.html'))))
+    parser.add_argument('--number', '-n', type=int, default=200, help='calls per extractor and method')
+    args = parser.parse_args()
+
+    for fixture in args.fixtures:
+        with open(fixture, encoding='utf-8') as f:
+            html = f.read()
+        print(f"{os.path.basename(fixture)} ({len(html)} bytes)")
+        expected = extractors['soup'].image_url(html), extractors['soup'].total_pages(html)
+        baseline = None
+        for name in ('soup', 'regex', 'auto'):
+            extractor = extractors[name]
+            found = extractor.image_url(html), extractor.total_pages(html)
+            if found != expected:
+                print(f"  {name}: MISMATCH {found!r} != {expected!r}")
+                continue
+            results = bench(extractor, html, args.number)
+            total = sum(results.values())
+            baseline = baseline or total
+            print(f"  {name:>5}: image_url {results['image_url'] * 1e6:9.1f}us  "
+                  f"total_pages {results['total_pages'] * 1e6:9.1f}us  speedup x{baseline / total:.1f}")
@@ -0,0 +1,57 @@
+'''Benchmark of pages/sec with html parsed inline on the event loop vs in a ProcessPoolExecutor.
+Every simulated page waits --latency seconds (the network) and then extracts the image url and
+page count from a saved fixture, with --concurrency pages in flight.
+Usage: python benchmarks/bench_parsing.py [--extractor soup] [--processes 4] [--concurrency 10 50 100]'''
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import argparse
+import asyncio
+import glob
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extractors import extractors, extract
+
+
+async def run(html, extractor, pool, pages, concurrency, latency):
+    '''Returns pages/sec for pages simulated pages with at most concurrency in flight'''
+    loop = asyncio.get_running_loop()
+    sema = asyncio.Semaphore(concurrency)
+
+    async def page():
+        async with sema:
+            await asyncio.sleep(latency)
+        for method in ('image_url', 'total_pages'):
+            if pool is None:
+                getattr(extractors[extractor], method)(html)
+            else:
+                await loop.run_in_executor(pool, extract, extractor, method, html)
+
+    start = perf_counter()
+    await asyncio.gather(*(page() for _ in range(pages)))
+    return pages / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+    fixtures = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', '*.html')))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixture', default=fixtures[0])
+    parser.add_argument('--extractor', '-e', choices=extractors, default='soup')
+    parser.add_argument('--processes', '-p', type=int, default=os.cpu_count())
+    parser.add_argument('--concurrency', '-c', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--pages', '-n', type=int, default=500)
+    parser.add_argument('--latency', '-l', type=float, default=0.05, help='simulated seconds per request')
+    args = parser.parse_args()
+
+    with open(args.fixture, encoding='utf-8') as f:
+        html = f.read()
+    print(f"{args.pages} pages of {os.path.basename(args.fixture)}, {args.extractor} extractor, {args.latency}s latency")
+    with ProcessPoolExecutor(args.processes) as pool:
+        # warm the workers up so process start up isn't measured
+        list(pool.map(extract, [args.extractor] * args.processes, ['image_url'] * args.processes, [html] * args.processes))
+        for concurrency in args.concurrency:
+            inline = asyncio.run(run(html, args.extractor, None, args.pages, concurrency, args.latency))
+            pooled = asyncio.run(run(html, args.extractor, pool, args.pages, concurrency, args.latency))
+            print(f"  concurrency {concurrency:>4}: inline {inline:8.1f} pages/s  "
+                  f"pool({args.processes}) {pooled:8.1f} pages/s  x{pooled / inline:.2f}")
@@ -0,0 +1,124 @@
+'''Cold start benchmark of the CLI entry points, from python -X importtime.
+For every module it reports the median total import time over --runs fresh interpreters and the heaviest imports.
+With --nothing-new it also times whole asyncborutov2 runs against benchmarks/stub_server.py once every chapter
+is already downloaded, the path cron runs take most of the time, and lists which heavy modules it still loaded.
+Usage: python benchmarks/bench_startup.py [--modules asyncborutov2 client] [--runs 10] [--nothing-new] [--json out.json]'''
+from time import perf_counter
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from bench_engines import StubThread, ROOT
+
+HEAVY = ('aiohttp', 'bs4', 'requests', 'fuzzywuzzy', 'aiofiles', 'PIL', 'multiprocessing', 'concurrent.futures.process')
+# imported by the interpreter itself (and site hooks) before any of our code
+STARTUP = ('site', 'encodings', 'codecs', 'io', 'abc', 'zipimport', '_frozen_importlib_external')
+
+
+def importtime(stderr):
+    '''
+    {module: cumulative us} and the total import time in us out of -X importtime output,
+    leaving out what the interpreter imports at startup
+    '''
+    modules, total, skipping = {}, 0, []
+    lines = [line[len('import time:'):].split('|') for line in stderr.splitlines()
+             if line.startswith('import time:') and 'self [us]' not in line]
+    # children are printed before their parent, so walk backwards to know which subtree each line is in
+    for own, cumulative, name in reversed(lines):
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        del skipping[depth:]
+        if depth == 0 and name in STARTUP:
+            skipping.append(name)
+        if skipping:
+            continue
+        modules[name] = int(cumulative)
+        if depth == 0:
+            total += int(cumulative)
+    return modules, total
+
+
+def run(args, env, cwd=None):
+    start = perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return perf_counter() - start, process
+
+
+def bench_imports(module, runs, env, top):
+    totals, modules = [], {}
+    for _ in range(runs):
+        _, process = run(['-c', f'import {module}'], env)
+        if process.returncode:
+            return {'module': module, 'error': process.stderr.strip().splitlines()[-1]}
+        modules, total = importtime(process.stderr)
+        totals.append(total)
+    heaviest = sorted(((name, cumulative) for name, cumulative in modules.items() if name != module),
+                      key=lambda item: -item[1])
+    return {
+        'module': module,
+        'median_ms': round(statistics.median(totals) / 1000, 1),
+        'min_ms': round(min(totals) / 1000, 1),
+        'heavy_loaded': [name for name in HEAVY if name in modules],
+        'heaviest': [(name, round(cumulative / 1000, 1)) for name, cumulative in heaviest[:top]],
+    }
+
+
+def bench_nothing_new(runs, env):
+    '''Wall and import time of asyncborutov2 runs that find every chapter already downloaded'''
+    stub = StubThread(chapters=2, pages=3, image_size=4096)
+    env = dict(env, MANGAREADER_URL=stub.stub.url)
+    args = [os.path.join(ROOT, 'asyncborutov2.py'), '--preset', 'naruto', '--quiet']
+    walls, totals, modules = [], [], {}
+    with tempfile.TemporaryDirectory() as path:
+        _, process = run(args + ['--path', path], env)
+        if process.returncode:
+            return {'error': process.stderr.strip().splitlines()[-1]}
+        for _ in range(runs):
+            wall, process = run(args + ['--path', path], env)
+            modules, total = importtime(process.stderr)
+            walls.append(wall)
+            totals.append(total)
+    return {
+        'median_wall_ms': round(statistics.median(walls) * 1000, 1),
+        'median_import_ms': round(statistics.median(totals) / 1000, 1),
+        'heavy_loaded': [name for name in HEAVY if name in modules],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', nargs='+', default=['asyncborutov2', 'client', 'asyncboruto', 'boruto'])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=5, help='heaviest imports to list per module')
+    parser.add_argument('--nothing-new', dest='nothing_new', action='store_true',
+                        help='also time whole asyncborutov2 runs with nothing new to download')
+    parser.add_argument('--json', dest='json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    results = {'imports': [], 'nothing_new': None}
+    for module in args.modules:
+        result = bench_imports(module, args.runs, env, args.top)
+        results['imports'].append(result)
+        if 'error' in result:
+            print(f"{module:>14}: {result['error']}")
+            continue
+        print(f"{module:>14}: {result['median_ms']:7.1f}ms median {result['min_ms']:7.1f}ms min  "
+              f"heavy: {', '.join(result['heavy_loaded']) or '-'}")
+        for name, ms in result['heaviest']:
+            print(f"{'':>16}{ms:7.1f}ms {name}")
+    if args.nothing_new:
+        result = results['nothing_new'] = bench_nothing_new(args.runs, env)
+        if 'error' in result:
+            print(f"   nothing new: {result['error']}")
+        else:
+            print(f"   nothing new: {result['median_wall_ms']:7.1f}ms wall, {result['median_import_ms']:7.1f}ms importing  "
+                  f"heavy: {', '.join(result['heavy_loaded']) or '-'}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
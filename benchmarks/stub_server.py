@@ -0,0 +1,130 @@
+'''Local aiohttp stand in for mangareader.net, serving synthetic series for offline benchmarks.
+Routes:
+    /actions/search/?q=        pipe separated search results, one line per series
+    /alphabetical              list of every series
+    /{series}                  manga index, the first link of the third <ul> is the latest chapter
+    /{series}/{chapter}/{page} page html with div#selectpage and div#imgholder img
+    /img/{series}/{chapter}/{page}.jpg  a jpeg payload of --image-size bytes
+Chapters past --chapters answer a page without the divs, like mangareader does for unreleased chapters.
+Every response waits latency +- jitter seconds and html/image responses fail with a 503 at --error-rate
+Usage: python benchmarks/stub_server.py [--port 8080] [--latency 0.05] [--error-rate 0.01]'''
+from time import perf_counter
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+
+class StubServer:
+    '''Synthetic mangareader.net, see the module docstring. latencies and counts are recorded per route kind'''
+
+    def __init__(self, series=('naruto', 'boruto-naruto-next-generations'), chapters=5, pages=20,
+                 image_size=200 * 1024, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.series = series
+        self.chapters = chapters
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.image = b'\xff\xd8\xff\xe0' + self.random.randbytes(max(image_size - 6, 0)) + b'\xff\xd9'
+        self.latencies = {}
+        self.counts = {}
+        self.runner = None
+        self.url = None
+
+    def app(self):
+        app = web.Application(middlewares=[self.instrument])
+        app.router.add_get('/actions/search/', self.search)
+        app.router.add_get('/alphabetical', self.alphabetical)
+        app.router.add_get('/img/{series}/{chapter}/{page}.jpg', self.image_file)
+        app.router.add_get('/{series}', self.index)
+        app.router.add_get('/{series}/{chapter}/{page}', self.page)
+        return app
+
+    @web.middleware
+    async def instrument(self, request, handler):
+        kind = 'image' if request.path.startswith('/img/') else 'html'
+        start = perf_counter()
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if delay:
+            await asyncio.sleep(delay)
+        if kind in ('image', 'html') and self.random.random() < self.error_rate:
+            response = web.Response(status=503)
+        else:
+            response = await handler(request)
+        self.latencies.setdefault(kind, []).append(perf_counter() - start)
+        self.counts[(kind, response.status)] = self.counts.get((kind, response.status), 0) + 1
+        return response
+
+    async def search(self, request):
+        rows = [f"{name.replace('-', ' ').title()}|/cover/{name}.jpg|{name}|Some Author|/{name}|{index}"
+                for index, name in enumerate(self.series)]
+        return web.Response(text='\n'.join(rows) + '\n')
+
+    async def alphabetical(self, request):
+        items = ''.join(f'<li><a href="/{name}"> {name.replace("-", " ").title()}</a></li>' for name in self.series)
+        return web.Response(text=f'<html><body><ul class="series_alpha">{items}</ul></body></html>',
+                            content_type='text/html')
+
+    async def index(self, request):
+        name = request.match_info['series']
+        if name not in self.series:
+            raise web.HTTPNotFound()
+        chapters = ''.join(f'<li><a href="/{name}/{chapter}">{name} {chapter}</a></li>'
+                           for chapter in range(self.chapters, 0, -1))
+        html = (f'<html><body><ul><li>menu</li></ul><ul><li>genres</li></ul>'
+                f'<ul class="latest">{chapters}</ul></body></html>')
+        return web.Response(text=html, content_type='text/html')
+
+    async def page(self, request):
+        name = request.match_info['series']
+        chapter, page = int(request.match_info['chapter']), int(request.match_info['page'])
+        if name not in self.series:
+            raise web.HTTPNotFound()
+        if chapter > self.chapters or page > self.pages:
+            return web.Response(text='<html><body><p>Not released yet</p></body></html>', content_type='text/html')
+        options = ''.join(f'<option value="/{name}/{chapter}/{number}">{number}</option>'
+                          for number in range(1, self.pages + 1))
+        html = (f'<html><head><title>{name} {chapter} page {page}</title></head><body>'
+                f'<div id="selectpage"><select id="pageMenu">{options}</select> of {self.pages}</div>'
+                f'<div id="imgholder"><a href="/{name}/{chapter}/{page + 1}">'
+                f'<img id="img" src="{self.url}/img/{name}/{chapter}/{page}.jpg" alt="{name}" /></a></div>'
+                f'</body></html>')
+        return web.Response(text=html, content_type='text/html')
+
+    async def image_file(self, request):
+        return web.Response(body=self.image, content_type='image/jpeg')
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--chapters', type=int, default=5)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--image-size', type=int, default=200 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    async def serve():
+        stub = StubServer(chapters=args.chapters, pages=args.pages, image_size=args.image_size,
+                          latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        print(f"Serving on {await stub.start(port=args.port)}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
@@ -1,16 +1,15 @@
 '''This is very slow, waiting synchronously for every request to finish for the next one to start'''
-from decorators import ResponseTimer
-from bs4 import BeautifulSoup
+from extractors import extractors, ExtractionError
+from manifest import Manifest
 import argparse
 import requests
 import shutil
-import glob
 import os
 import sys
 
 class Scraper:
     def __init__(self):
-        self.base_url = 'https://www.mangareader.net/boruto-naruto-next-generations/'
+        self.base_url = f"{os.environ.get('MANGAREADER_URL', 'https://www.mangareader.net')}/boruto-naruto-next-generations/"
         self.base_path = os.path.join(os.getcwd(), 'Boruto')
 
         parser = argparse.ArgumentParser()
@@ -19,10 +18,14 @@ class Scraper:
         args = parser.parse_args()
 
         self.debug = args.debug
+        self.extractor = extractors['auto']
         self.write_to_file = args.download
+        self.manifest = Manifest(self.base_path)
         self.current_chapter = self.get_last_chapter()
         self.current_page = self.get_last_page()
         if self.debug:
+            # only --debug needs it
+            from decorators import ResponseTimer
             requests.get = ResponseTimer(requests.get)
         self.mkdir()
         self.main()
@@ -38,31 +41,10 @@ class Scraper:
         self.check()
 
     def get_last_chapter(self):
-        paths = glob.glob(os.path.join(self.base_path, '*/'))
-        chapter_list = []
-        if paths:
-            for chapter in paths:
-                chapter_dir = chapter.split(os.path.sep)[-2]
-                chapter_number = chapter_dir.strip('Chapter ')
-                chapter_list.append(int(chapter_number))
-            return max(chapter_list)
-        else:
-            return 1
+        return self.manifest.last_chapter
 
     def get_last_page(self):
-        path = os.path.join(
-            self.base_path, f'Chapter {self.current_chapter}', "*.jpg")
-        paths = glob.glob(path)
-        image_list = []
-        if paths:
-            for image in paths:
-                image_file = image.split(os.path.sep)[-1]
-                image_name = os.path.splitext(image_file)[0]
-                image_number = int(image_name[(len(image_name) - 2):])
-                image_list.append(image_number)
-            return max(image_list)
-        else:
-            return 1
+        return self.manifest.last_page(self.current_chapter)
 
     def reset(self):
         self.current_chapter += 1
@@ -73,14 +55,13 @@ class Scraper:
         try:
             with requests.get(self.current_endpoint) as response:
                 if response.ok:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    pages_in_chapter = soup.findAll('div', {'id': 'selectpage'})[0].text
-                    self.total_pages = int(pages_in_chapter[(len(pages_in_chapter)-2):])
+                    self.total_pages = self.extractor.total_pages(response.text)
+                    self.manifest.set_pages(self.current_chapter, self.total_pages)
                     if self.current_page == self.total_pages:
                         self.reset()
                 else:
                     response.raise_for_status()
-        except IndexError:
+        except ExtractionError:
             print('No new chapters yet, check again at 20th of every month')
             sys.exit()
 
@@ -93,8 +74,7 @@ class Scraper:
             try:
                 with requests.get(self.current_endpoint) as response:
                     if response.ok:
-                        soup = BeautifulSoup(response.text, 'html.parser')
-                        image_url = soup.findAll("div", attrs={"id": "imgholder"})[0].img["src"]
+                        image_url = self.extractor.image_url(response.text)
                         response = requests.get(image_url, stream=True)
                         photo = f'Boruto.ch{self.current_chapter}.p{str(self.current_page).zfill(3)}.jpg'
                         photo_path = os.path.join(self.base_path, self.directory, photo)
@@ -104,6 +84,8 @@ class Scraper:
                                     if not self.debug:
                                         print(f'Downloading {photo} at {self.directory}')
                                     shutil.copyfileobj(response.raw, out_file)
+                                self.manifest.add_page(self.current_chapter, self.current_page,
+                                                       os.path.getsize(photo_path), image_url)
 
                         if self.current_page == self.total_pages:
                             self.reset()
@@ -116,7 +98,7 @@ class Scraper:
             except KeyboardInterrupt:
                 break
 
-            except IndexError as e:
+            except ExtractionError as e:
                 print(f'Last chapter released is {self.current_chapter - 1}')
                 break
 
@@ -0,0 +1,170 @@
+'''SQLite backed cache of html responses, shared by the requests and aiohttp code paths.
+Entries are served as-is while younger than the ttl of their url class, stale entries are revalidated
+with If-None-Match/If-Modified-Since, and the least recently used entries are evicted past max_bytes'''
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from collections import namedtuple
+from time import time
+import sqlite3
+import threading
+import re
+
+# url classes, first match wins. The manga index is always revalidated since that's where new chapters show up,
+# released chapters don't change their page count
+URL_CLASSES = (
+    ('search', r'/actions/search/'),
+    ('chapter', r'/\d+/\d+/?$'),
+    ('index', r''),
+)
+DEFAULT_TTLS = {'search': 24 * 3600, 'chapter': 30 * 24 * 3600, 'index': 0}
+
+
+class HTTPStatusError(Exception):
+    '''Raised by CachedResponse.raise_for_status for 4xx and 5xx responses'''
+
+    def __init__(self, status, url):
+        super().__init__(f"{status}@{url}")
+        self.status = status
+
+
+class CachedResponse(namedtuple('CachedResponse', ['status', 'text', 'url', 'cached'])):
+    '''Response returned by HTTPCache, cached is True when no body was downloaded'''
+
+    @property
+    def path(self):
+        return urlparse(self.url).path
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise HTTPStatusError(self.status, self.url)
+
+
+class HTTPCache:
+    '''Cache of html responses. A path of None disables it, every request then goes upstream'''
+
+    def __init__(self, path, ttls=None, max_bytes=64 * 1024 * 1024):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.classes = [(name, re.compile(pattern)) for name, pattern in URL_CLASSES]
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self.db = None
+        # get() runs in executor threads next to fetch() on the loop
+        self.lock = threading.Lock()
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY, body TEXT, etag TEXT, last_modified TEXT,
+                stored REAL, accessed REAL, size INTEGER)''')
+            self.db.commit()
+
+    def url_class(self, url):
+        for name, pattern in self.classes:
+            if pattern.search(url):
+                return name
+
+    def lookup(self, url):
+        '''Returns (body, etag, last_modified, stored) of url or None'''
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT body, etag, last_modified, stored FROM responses WHERE url = ?',
+                                  (url,)).fetchone()
+            if row:
+                self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (time(), url))
+        return row
+
+    def is_fresh(self, url, row):
+        return time() - row[3] < self.ttls[self.url_class(url)]
+
+    def validators(self, row):
+        '''Conditional request headers for a stale entry'''
+        headers = {}
+        if row and row[1]:
+            headers['If-None-Match'] = row[1]
+        if row and row[2]:
+            headers['If-Modified-Since'] = row[2]
+        return headers
+
+    def store(self, url, body, headers):
+        if self.db is None:
+            return
+        now = time()
+        self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (url, body, headers.get('ETag'), headers.get('Last-Modified'), now, now, len(body)))
+        self.evict()
+        self.db.commit()
+
+    def invalidate(self, url):
+        '''Drops url, for a 200 whose body turned out to be an error page'''
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.db.commit()
+
+    def refresh(self, url):
+        '''Marks url as fresh again after a 304 Not Modified'''
+        self.db.execute('UPDATE responses SET stored = ? WHERE url = ?', (time(), url))
+        self.db.commit()
+
+    def evict(self):
+        '''Deletes the least recently accessed entries until the cache fits in max_bytes'''
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY accessed').fetchall():
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def resolve(self, url, row, status, text, headers):
+        '''Turns an upstream response into a CachedResponse, updating the cache'''
+        with self.lock:
+            if status == 304 and row:
+                self.stats['revalidated'] += 1
+                self.refresh(url)
+                return CachedResponse(200, row[0], url, True)
+            self.stats['misses'] += 1
+            if status == 200:
+                self.store(url, text, headers)
+            return CachedResponse(status, text, url, False)
+
+    def get(self, url, headers=None, timeout=30):
+        '''
+        Synchronous GET of url through the cache with urllib, which is much cheaper to import than
+        requests or aiohttp when it's the only request of a run
+        '''
+        row = self.lookup(url)
+        if row and self.is_fresh(url, row):
+            self.stats['hits'] += 1
+            return CachedResponse(200, row[0], url, True)
+        request = Request(url, headers=dict(headers or {}, **self.validators(row)))
+        try:
+            response = urlopen(request, timeout=timeout)
+        except HTTPError as e:
+            # urllib raises for 304 and every error status, they're still responses here
+            response = e
+        with response:
+            body = response.read().decode(response.headers.get_content_charset() or 'utf-8', errors='replace')
+            return self.resolve(url, row, response.status, body if response.status == 200 else '', response.headers)
+
+    async def fetch(self, session, url):
+        '''Asynchronous GET of url through the cache with an aiohttp ClientSession'''
+        row = self.lookup(url)
+        if row and self.is_fresh(url, row):
+            self.stats['hits'] += 1
+            return CachedResponse(200, row[0], url, True)
+        async with session.get(url, headers=self.validators(row)) as response:
+            text = await response.text() if response.status == 200 else ''
+            return self.resolve(url, row, response.status, text, response.headers)
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
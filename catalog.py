@@ -0,0 +1,98 @@
+'''Local catalog of every series on mangareader, so --search is answered in milliseconds without a request.
+The catalog is kept at catalog.json and refreshed from the alphabetical series list once it's older than its ttl,
+every row the search endpoint returns is merged into it as well.
+Lookups go through a trigram index, only the candidates sharing the most trigrams with the query are
+scored with fuzz.ratio'''
+from collections import namedtuple
+from time import time
+import json
+import os
+import re
+
+# same fields as a row of /actions/search/
+Entry = namedtuple('Entry', ['Name', 'Image', 'Title', 'Creator', 'Endpoint', 'Index'])
+ALPHABETICAL_RE = re.compile(r'<li>\s*<a href="(/[^"/]+)"[^>]*>\s*([^<]+?)\s*</a>', re.IGNORECASE)
+
+
+def trigrams(text):
+    '''Set of the 3 character substrings of the normalized, space padded text'''
+    text = f"  {' '.join(re.findall(r'[a-z0-9]+', text.lower()))} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class Catalog:
+    '''Series entries by endpoint and their trigram index, only kept in memory with a path of None'''
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.updated = 0
+        self.entries = {}
+        self.index = {}
+        if path and os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.updated = data['updated']
+            for row in data['series']:
+                self.add(Entry(*row))
+
+    @property
+    def stale(self):
+        return time() - self.updated > self.ttl
+
+    def add(self, entry):
+        '''Adds or replaces the entry with the same endpoint, keeping fields the new one doesn't know'''
+        previous = self.entries.get(entry.Endpoint)
+        if previous:
+            entry = Entry(*(new or old for new, old in zip(entry, previous)))
+        self.entries[entry.Endpoint] = entry
+        for gram in trigrams(entry.Name):
+            self.index.setdefault(gram, set()).add(entry.Endpoint)
+
+    def add_search_rows(self, text):
+        '''Merges the pipe separated rows of a search response, returning their entries'''
+        entries = [Entry(*line.split('|')[:6]) for line in text.split('\n') if line.count('|') >= 5]
+        for entry in entries:
+            self.add(entry)
+        return entries
+
+    def add_alphabetical(self, html):
+        '''Merges every series linked from the alphabetical list page, returning how many were found'''
+        found = 0
+        for endpoint, name in ALPHABETICAL_RE.findall(html):
+            self.add(Entry(name, None, endpoint.strip('/'), None, endpoint, None))
+            found += 1
+        return found
+
+    async def refresh(self, cache, session, base_url):
+        '''Reloads the alphabetical list from base_url through cache, returning the number of series listed'''
+        response = await cache.fetch(session, f"{base_url}/alphabetical")
+        response.raise_for_status()
+        found = self.add_alphabetical(response.text)
+        if found:
+            self.updated = time()
+            self.save()
+        return found
+
+    def save(self):
+        if not self.path:
+            return
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'updated': self.updated, 'series': [list(entry) for entry in self.entries.values()]}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def search(self, query, limit=10, candidates=50):
+        '''
+        Best limit entries for query as (rating, entry), best first.
+        Only the candidates entries sharing the most trigrams with query are scored with fuzz.ratio
+        '''
+        from fuzzywuzzy import fuzz
+        counts = {}
+        for gram in trigrams(query):
+            for endpoint in self.index.get(gram, ()):
+                counts[endpoint] = counts.get(endpoint, 0) + 1
+        best = sorted(counts, key=counts.get, reverse=True)[:candidates]
+        query = query.lower()
+        scored = [(fuzz.ratio(self.entries[endpoint].Name.lower(), query), self.entries[endpoint]) for endpoint in best]
+        scored.sort(key=lambda scored: scored[0], reverse=True)
+        return scored[:limit]
@@ -0,0 +1,577 @@
+'''Library core of the scraper. MangaClient streams the chapters, pages and images of a series lazily,
+or downloads whole series into storage through a pipeline of worker pools:
+
+    async with MangaClient() as client:
+        series = client.series('naruto')
+        async for chapter in client.iter_chapters(series, start=700):
+            async for page in client.iter_pages(chapter):
+                image = await page.read()
+
+Creating a client makes no request, everything happens in the coroutines.
+Modules only some runs need (aiohttp, bs4, the process pools, the dedup store) are imported on first use'''
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse, urlencode
+from time import strftime, perf_counter
+from extractors import extractors, extract, latest_chapter, ExtractionError
+from functools import partial
+from storage import storages, BufferedBody, CHUNK_SIZE
+from manifest import Manifest
+from cache import HTTPCache
+from limiter import AdaptiveLimiter
+from retry import RetryPolicy, PERMANENT
+from scheduler import Policy, POLICIES
+from session import SessionFactory
+from metrics import Metrics, LONG_BUCKETS
+from catalog import Catalog
+from collections import deque, namedtuple
+import os
+import json
+
+import asyncio
+
+# MANGAREADER_URL points the scraper at another host, e.g. benchmarks/stub_server.py
+BASE_URL = os.environ.get('MANGAREADER_URL', 'https://www.mangareader.net')
+PRESETS = {
+    'boruto': {
+        'directory': 'Boruto Naruto Next Generations',
+        'endpoint': '/boruto-naruto-next-generations',
+        'creator': 'KODACHI Ukyo',
+        'image_name': 'Boruto'
+    },
+    'naruto': {
+        'directory': 'Naruto',
+        'endpoint': '/naruto',
+        'creator': 'KISHIMOTO Masashi',
+        'image_name': 'Naruto'
+    }
+}
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:74.0) Gecko/20100101 Firefox/74.0'}
+
+Chapter = namedtuple('Chapter', ['series', 'number', 'pages'])
+
+
+class DownloadError(Exception):
+    '''Raised when a url runs out of attempts, its failure record is in series.retry.failures'''
+
+
+class Series:
+    '''
+    State of one manga series: where it's saved, its manifest and what went wrong during this run.
+    With a path of None nothing is saved, the series can only be streamed with iter_chapters/iter_pages.
+    log gets the retries and give ups of series.retry, None to keep them quiet
+    '''
+    def __init__(self, path, directory, endpoint, image_name, creator=None, retries=5, storage='directory',
+                 dedup=None, base_url=None, extension='jpg', log=print):
+        self.directory = directory
+        self.base_endpoint = endpoint
+        self.image_name = image_name
+        self.creator = creator
+        self.manga_url = f"{base_url or BASE_URL}{endpoint}"
+        self.retry = RetryPolicy(attempts=retries, log=log)
+        self.runtime_pages = 0
+        self.errors = []
+        self.base_path = self.manifest = self.storage = None
+        if path is not None:
+            self.base_path = os.path.join(path, directory)
+            os.makedirs(self.base_path, exist_ok=True)
+            self.manifest = Manifest(self.base_path)
+            self.storage = storages[storage](self.base_path, image_name, self.manifest, dedup, extension)
+        self.initial = self.last_chapter
+
+    @property
+    def last_chapter(self):
+        '''Gets the last chapter created'''
+        return self.manifest.last_chapter if self.manifest else 1
+
+    def close(self):
+        '''Appends this run's errors to error.log, closes the storage and the manifest'''
+        if self.base_path is None:
+            return
+        with open(os.path.join(self.base_path, 'error.log'), 'a') as errorlog:
+            error_obj = {"missing chapters": self.errors, "failures": self.retry.failures}
+            json.dump(error_obj, errorlog)
+            errorlog.write('\n')
+        self.storage.close()
+        self.manifest.close()
+
+
+class Page:
+    '''A page of a chapter and the url of its image, the image is only requested by chunks() or read()'''
+
+    def __init__(self, client, series, chapter, number, url, image_url):
+        self.client = client
+        self.series = series
+        self.chapter = chapter
+        self.number = number
+        self.url = url
+        self.image_url = image_url
+
+    def __repr__(self):
+        return f"Page({self.series.directory!r}, chapter={self.chapter}, number={self.number}, image_url={self.image_url!r})"
+
+    async def chunks(self, chunk_size=CHUNK_SIZE):
+        '''Async generator of the bytes of the image as they arrive'''
+        async with self.client.open_image(self.series, self.image_url) as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def read(self):
+        '''The whole image'''
+        return b''.join([chunk async for chunk in self.chunks()])
+
+
+class MangaClient:
+    '''
+    Owns the shared session, html cache, limiter, metrics and parse pool of every request.
+    Use it as an async context manager, or await close() once done.
+    path is where series are saved (None to only stream them), cache, dedup and catalog are file paths or None.
+    transform is a transform.Transformer applied to every image between download and storage, or None.
+    schedule is the scheduler.Policy of the pipeline queues: round-robin, newest-first or complete-first.
+    log, if given, is called with a line per response and per created chapter
+    '''
+
+    def __init__(self, path=None, base_url=None, extractor='auto', parse_processes=0, storage='directory',
+                 dedup=None, cache=None, cache_ttls=None, cache_size=64 * 1024 * 1024, retries=5,
+                 html_limit=20, image_limit=50, connections=100, connections_per_host=0, dns_ttl=300,
+                 keepalive=30, catalog=None, catalog_ttl=7 * 24 * 3600, chapter_workers=5, page_workers=25,
+                 image_workers=25, queue_size=100, skip_existing=False, validate=False, transform=None,
+                 schedule='round-robin', log=None):
+        self.path = path
+        self.base_url = base_url or BASE_URL
+        self.extractor_name = extractor
+        self.extractor = extractors[extractor]
+        self.parse_pool = None
+        if parse_processes > 0:
+            from concurrent.futures import ProcessPoolExecutor
+            self.parse_pool = ProcessPoolExecutor(parse_processes)
+        self.storage = storage
+        self.retries = retries
+        self.chapter_workers = chapter_workers
+        self.page_workers = page_workers
+        self.image_workers = image_workers
+        self.queue_size = queue_size
+        self.validate = validate
+        self.skip_existing = skip_existing or validate
+        self.transform = transform
+        if schedule not in POLICIES:
+            raise ValueError(f"Unknown schedule {schedule!r}, choose one of {', '.join(POLICIES)}")
+        self.schedule = schedule
+        self.log = log
+        # (directory, chapter): (queued, started) of the chapters downloading, the last completed ones
+        self.chapter_times = {}
+        self.completed = deque(maxlen=20)
+        self.cache = HTTPCache(cache, cache_ttls, cache_size)
+        self.dedup = None
+        if dedup:
+            from dedup import BlobStore
+            self.dedup = BlobStore(dedup)
+        self.catalog = Catalog(catalog, catalog_ttl)
+        self.limiter = AdaptiveLimiter(urlparse(self.base_url).netloc,
+                                       {'initial': min(8, html_limit), 'maximum': html_limit},
+                                       {'initial': min(16, image_limit), 'maximum': image_limit})
+        self.sessions = SessionFactory(HEADERS, connections, connections_per_host, dns_ttl, keepalive)
+        self.metrics = Metrics({'limiter': self.limiter.metrics,
+                                'connections': lambda: dict(self.sessions.stats, reuse_ratio=round(self.sessions.reuse_ratio, 3)),
+                                'cache': lambda: dict(self.cache.stats),
+                                'chapters': lambda: dict(self.completed)})
+        if self.dedup:
+            self.metrics.sources['dedup'] = self.dedup.metrics
+        self.opened = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        '''Closes the session, the parse pool, the caches and every series created by self.series'''
+        await self.sessions.close()
+        if self.parse_pool:
+            self.parse_pool.shutdown()
+        if self.transform:
+            self.transform.close()
+        for series in self.opened:
+            series.close()
+        self.cache.close()
+        if self.dedup:
+            self.dedup.close()
+
+    def series(self, entry, directory=None):
+        '''
+        Creates a Series from a preset name, a dict with the same keys as the presets or a catalog.Entry,
+        saved under self.path
+        '''
+        if isinstance(entry, str):
+            entry = PRESETS[entry]
+        elif not isinstance(entry, dict):
+            entry = {'directory': directory or entry.Name, 'endpoint': entry.Endpoint,
+                     'image_name': entry.Name.split(' ')[0], 'creator': entry.Creator}
+        series = Series(self.path, entry['directory'], entry['endpoint'], entry['image_name'], entry.get('creator'),
+                        self.retries, self.storage, self.dedup, self.base_url,
+                        self.transform.extension if self.transform else 'jpg', self.log)
+        self.opened.append(series)
+        return series
+
+    async def search(self, query, limit=10):
+        '''
+        Best limit (rating, catalog.Entry) matches of query in self.catalog, refreshing it first when it's stale.
+        The search endpoint is only requested when the catalog has no match
+        '''
+        session = self.sessions.session()
+        if self.catalog.stale:
+            try:
+                await self.catalog.refresh(self.cache, session, self.base_url)
+            except Exception as e:
+                if self.log:
+                    self.log(f"Couldn't refresh the catalog, searching the cached one: {e}")
+        matches = self.catalog.search(query, limit)
+        if not matches:
+            payload = urlencode({"q": query.lower(), "limit": 100})
+            response = await self.cache.fetch(session, f"{self.base_url}/actions/search/?{payload}")
+            response.raise_for_status()
+            self.catalog.add_search_rows(response.text)
+            self.catalog.save()
+            matches = self.catalog.search(query, limit)
+        return matches
+
+    async def end_chapter(self, series):
+        '''
+        The last chapter available of series, retried by series.retry.
+        Raises DownloadError when the index runs out of attempts
+        '''
+        latest = await series.retry.call(series.manga_url, self.index, series)
+        if latest is None:
+            raise DownloadError(f"Couldn't get the chapters of {series.directory} from {series.manga_url}")
+        return latest
+
+    async def index(self, series):
+        '''
+        Makes a request to series.manga_url to get the last chapter available.
+        Until the aiohttp session exists the request goes through urllib in a thread,
+        so a run that finds nothing new never imports aiohttp
+        '''
+        with self.metrics.time('index'):
+            if self.sessions.started:
+                response = await self.cache.fetch(self.sessions.session(), series.manga_url)
+            else:
+                response = await asyncio.get_running_loop().run_in_executor(
+                    None, partial(self.cache.get, series.manga_url, HEADERS))
+        response.raise_for_status()
+        try:
+            return latest_chapter(response.text)
+        except ExtractionError:
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(response.text, 'html.parser')
+            try:
+                last_a = soup.findAll('ul')[2].findAll('a')[0]['href']
+                return int(last_a.split('/')[-1])
+            except (IndexError, KeyError, ValueError):
+                self.cache.invalidate(series.manga_url)
+                raise ExtractionError(f"No chapter list in {series.manga_url}")
+
+    async def iter_chapters(self, series, start=None, end=None):
+        '''
+        Yields a Chapter for every released chapter of series from start (series.initial by default)
+        to end (the last chapter available by default), requesting the first page of each for its page count
+        '''
+        session = self.sessions.session()
+        end = end or await self.end_chapter(series)
+        for number in range(start or series.initial, end + 1):
+            pages = await series.retry.call(f"{series.manga_url}/{number}/1", self.chapter_pages, session, series, number)
+            if pages:
+                yield Chapter(series, number, pages)
+
+    async def iter_pages(self, chapter, pages=None):
+        '''
+        Yields a Page for every page of chapter (or only the page numbers in pages), in order.
+        Up to page_workers pages are requested and parsed ahead of the consumer,
+        pages that run out of attempts are skipped and end up in series.retry.failures
+        '''
+        session = self.sessions.session()
+        window = deque()
+        try:
+            for number in pages if pages is not None else range(1, chapter.pages + 1):
+                window.append(asyncio.ensure_future(self.page(session, chapter.series, chapter.number, number)))
+                if len(window) >= self.page_workers:
+                    page = await window.popleft()
+                    if page:
+                        yield page
+            while window:
+                page = await window.popleft()
+                if page:
+                    yield page
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def page(self, session, series, chapter, number):
+        '''The Page number of chapter, or None if its html kept failing'''
+        url = f"{series.manga_url}/{chapter}/{number}"
+        job = await series.retry.call(url, self.parse_page, session, url)
+        return Page(self, series, chapter, number, url, job[2]) if job else None
+
+    @asynccontextmanager
+    async def open_image(self, series, url):
+        '''
+        Response of the image at url, retried by series.retry until its headers arrive.
+        The limiter slot is released with the headers, so a slow consumer isn't taken for a slow host
+        '''
+        response = await series.retry.call(url, self.request_image, url)
+        if response is None:
+            raise DownloadError(url)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def request_image(self, url):
+        start = perf_counter()
+        async with self.limiter.request(url) as slot:
+            with self.metrics.time('image'):
+                response = await self.sessions.session().get(url)
+                slot.response(response.status)
+                self.printer(response.status, response.url.path, start)
+                if response.status >= 400:
+                    response.release()
+                    response.raise_for_status()
+        return response
+
+    async def download(self, *series):
+        '''
+        Downloads the missing chapters of every series into its storage, as a pipeline of three stages connected
+        by bounded queues: chapter discovery (self.fetch) -> page html parsing (self.parse) -> image download
+        (self.download_image). Each stage has its own pool of workers, so pages of the next chapter start while
+        the slowest pages of the previous one are still downloading, keeping self.limiter saturated.
+        Every series shares the same session and workers, the FairQueues hand out their jobs in the order
+        of self.schedule: round robin between series, newest chapters first, or chapters in flight first.
+        Returns {directory: chapters downloaded, or the exception that kept the series from starting}
+        '''
+        pending = await asyncio.gather(*(self.pending_chapters(entry) for entry in series), return_exceptions=True)
+        # a series whose index failed doesn't hold back the others
+        await self.run_pipeline([(entry, chapter) for entry, chapters in zip(series, pending)
+                                 if not isinstance(chapters, Exception) for chapter in chapters])
+        return {entry.directory: chapters for entry, chapters in zip(series, pending)}
+
+    async def run_pipeline(self, jobs):
+        '''Runs the workers of each stage over the (series, chapter) jobs until the queues drain'''
+        key = lambda job: job[0].directory
+        policy = Policy(self.schedule)
+        chapter_queue = policy.queue(key, 'chapter')
+        page_queue = policy.queue(key, 'page', maxsize=self.queue_size)
+        image_queue = policy.queue(key, 'image', maxsize=self.queue_size)
+        queued = perf_counter()
+        for series, chapter in jobs:
+            series.manifest.queue_chapter(chapter)
+            chapter_queue.put_nowait((series, chapter))
+        if not chapter_queue.empty():
+            session = self.sessions.session()
+            stages = (
+                (chapter_queue, self.chapter_workers, lambda job: self.fetch(session, *job, page_queue, queued)),
+                (page_queue, self.page_workers, lambda job: self.parse(session, *job, image_queue)),
+                (image_queue, self.image_workers, lambda job: self.download_image(session, *job)),
+            )
+            workers = [asyncio.ensure_future(self.worker(queue, handler))
+                       for queue, count, handler in stages for _ in range(count)]
+            try:
+                # items only flow forward, so joining in stage order drains the whole pipeline
+                for queue, _, _ in stages:
+                    await queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    async def pending_chapters(self, series, latest_chapter=None):
+        '''
+        Chapters of series to download: from series.initial to the end chapter (requested unless given),
+        skipping the ones the manifest knows are complete or missing upstream, plus earlier chapters
+        the manifest knows are incomplete, including the ones whose page count never arrived
+        '''
+        if latest_chapter is None:
+            latest_chapter = await self.end_chapter(series)
+        manifest = series.manifest
+        # with skip_existing every known chapter is checked against disk, complete ones included
+        if self.skip_existing:
+            for chapter in list(manifest.chapters):
+                self.reconcile(series, chapter)
+        chapters = [chapter for chapter in manifest.incomplete_chapters() if chapter < series.initial]
+        chapters += [chapter for chapter in range(series.initial, latest_chapter + 1) if manifest.incomplete(chapter)]
+        return chapters
+
+    async def worker(self, queue, handler):
+        '''
+        Consumes items from queue forever, awaiting handler(item) for each one.
+        Items start with their series, what handler raises is recorded in its failures for error.log
+        '''
+        while True:
+            item = await queue.get()
+            try:
+                await handler(item)
+            except Exception as e:
+                series = item[0]
+                key = item[-1] if len(item) > 2 else f"{series.manga_url}/{item[1]}"
+                series.retry.give_up(key, PERMANENT, e, 1)
+            finally:
+                queue.task_done()
+
+    async def fetch(self, session, series, chapter, page_queue, queued=None):
+        '''
+        Get request @ the first page of chapter, parsing response.text() with self.extractor
+        Gets the total_pages for that chapter.
+        Puts every page endpoint of the chapter missing from the manifest in page_queue, to be parsed by self.parse
+        With self.skip_existing, the request is skipped when the manifest already knows total_pages
+        and missing pages are checked against disk.
+        queued is when the chapter was queued, for its time to complete
+        '''
+        started = perf_counter()
+        manifest = series.manifest
+        if not (self.skip_existing and manifest.pages(chapter) is not None):
+            pages = await series.retry.call(f"{series.manga_url}/{chapter}/1", self.chapter_pages, session, series, chapter)
+            if pages is not None:
+                manifest.set_pages(chapter, pages)
+        if manifest.pages(chapter) is None:
+            return
+        self.open_chapter(series, chapter)
+        missing = self.reconcile(series, chapter) if self.skip_existing else manifest.missing(chapter)
+        if missing:
+            self.chapter_times[(series.directory, chapter)] = (queued or started, started)
+        for endpoint in (f"{series.manga_url}/{chapter}/{page}" for page in missing):
+            await page_queue.put((series, chapter, endpoint))
+
+    async def chapter_pages(self, session, series, chapter):
+        '''Requests the first page of chapter, returning its total pages or None if the chapter doesn't exist'''
+        url = f"{series.manga_url}/{chapter}/1"
+        start = perf_counter()
+        async with self.limiter.request(url) as slot:
+            with self.metrics.time('index'):
+                response = await self.cache.fetch(session, url)
+                self.printer(response.status, response.path, start)
+                if not response.cached:
+                    slot.response(response.status)
+                if response.status == 404:
+                    series.errors.append(url)
+                    if series.manifest is not None:
+                        series.manifest.not_found(chapter)
+                    return None
+                response.raise_for_status()
+        try:
+            return await self.extract('total_pages', response.text)
+        except ExtractionError:
+            # an error page served with a 200 mustn't answer the retries from the cache
+            self.cache.invalidate(url)
+            raise
+
+    async def extract(self, method, html):
+        '''Runs self.extractor.method(html) in self.parse_pool if there is one, else inline'''
+        if self.parse_pool is None:
+            return getattr(self.extractor, method)(html)
+        return await asyncio.get_running_loop().run_in_executor(self.parse_pool, extract, self.extractor_name,
+                                                                method, html)
+
+    def reconcile(self, series, chapter):
+        '''
+        Checks the pages of chapter against series.storage before any request is made.
+        Pages the manifest has but are gone (or fail validation) are forgotten,
+        stored pages the manifest doesn't have are recorded.
+        Returns the pages that still need downloading
+        '''
+        manifest, storage = series.manifest, series.storage
+        for page, info in list(manifest.done(chapter).items()):
+            if storage.stat(chapter, page, info['size'], self.validate) is None:
+                manifest.remove_page(chapter, page)
+        missing = []
+        for page in manifest.missing(chapter) or []:
+            size = storage.stat(chapter, page, validate=self.validate)
+            if size is not None:
+                manifest.add_page(chapter, page, size)
+            else:
+                missing.append(page)
+        return missing
+
+    async def parse(self, session, series, chapter, url, image_queue):
+        '''
+        Puts (series, chapter, page_number, img_url) of the image that the endpoint matched in image_queue.
+        Failed requests are retried by series.retry, urls that run out of attempts end up in error.log
+        '''
+        job = await series.retry.call(url, self.parse_page, session, url)
+        if job:
+            await image_queue.put((series, *job))
+
+    async def parse_page(self, session, url):
+        '''
+        Makes async http requests and parses it with self.extractor, once the request slot is released
+        Returns (chapter, page_number, img_url) of the image that the endpoint matched
+        '''
+        async with self.limiter.request(url) as slot:
+            with self.metrics.time('page'):
+                start = perf_counter()
+                async with session.get(url) as response:
+                    slot.response(response.status)
+                    self.printer(response.status, response.url.path, start)
+                    response.raise_for_status()
+                    page_number = os.path.splitext(url)[0].split('/')[-1]
+                    chapter = os.path.splitext(url)[0].split('/')[-2]
+                    html = await response.text()
+        return chapter, page_number, await self.extract('image_url', html)
+
+    async def download_image(self, session, series, chapter, page_number, img_url):
+        '''
+        Download's the image matched by self.parse into series.storage.
+        Failed requests are retried by series.retry, urls that run out of attempts end up in error.log
+        '''
+        await series.retry.call(img_url, self.save_image, session, series, chapter, page_number, img_url)
+
+    async def save_image(self, session, series, chapter, page_number, img_url):
+        '''
+        Streams img_url into series.storage, which records it in the manifest, returning True once stored.
+        With self.transform the image is read whole and transformed once the request slot is released
+        '''
+        async with self.limiter.request(img_url) as slot:
+            with self.metrics.time('image'):
+                start = perf_counter()
+                async with session.get(img_url) as response:
+                    slot.response(response.status)
+                    self.printer(response.status, response.url.path, start)
+                    response.raise_for_status()
+                    if self.transform is None:
+                        await series.storage.write(int(chapter), int(page_number), response, img_url, self.metrics)
+                        series.runtime_pages += 1
+                        self.chapter_progress(series, int(chapter))
+                        return True
+                    data = await response.read()
+        image, thumbnail = await self.transform(data, self.metrics)
+        await series.storage.write(int(chapter), int(page_number), BufferedBody(image), img_url, self.metrics)
+        if thumbnail is not None:
+            await series.storage.write_thumbnail(int(chapter), int(page_number), thumbnail)
+        series.runtime_pages += 1
+        self.chapter_progress(series, int(chapter))
+        return True
+
+    def chapter_progress(self, series, chapter):
+        '''
+        Once the last page of a chapter fetched by this run is stored, observes its time to complete as the 'chapter'
+        stage of self.metrics (from its first request) and 'chapter_queued' (from when it was queued)
+        '''
+        if (series.directory, chapter) not in self.chapter_times or series.manifest.missing(chapter) != []:
+            return
+        queued, started = self.chapter_times.pop((series.directory, chapter))
+        now = perf_counter()
+        self.metrics.observe('chapter', now - started, LONG_BUCKETS)
+        self.metrics.observe('chapter_queued', now - queued, LONG_BUCKETS)
+        self.completed.append((f"{series.directory} {chapter}", {'seconds': round(now - started, 2),
+                                                                 'queued_seconds': round(now - queued, 2)}))
+        if self.log:
+            self.log(f"{series.directory}: Chapter {chapter} complete in {now - started:.2f}s, "
+                     f"{now - queued:.2f}s after it was queued")
+
+    def open_chapter(self, series, chapter):
+        '''Creates the directory or archive of chapter, once per chapter instead of checking it for every page'''
+        created = series.storage.open_chapter(chapter)
+        if created and self.log:
+            self.log(f"Creating {created}")
+
+    def printer(self, status, url_path, start):
+        '''Logs a line per response with its duration, when there is a log'''
+        if self.log:
+            self.log(f"{strftime('[%d/%m/%Y %H:%M:%S]')} {status}@{url_path!r} finished in {(perf_counter() - start):.2f}")
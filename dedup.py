@@ -0,0 +1,173 @@
+'''Content addressed store for downloaded images, so credit pages and fillers repeated across chapters and series
+are kept once. Images are hashed while they stream in, each distinct image is written once as a blob at
+{path}/{hash[:2]}/{hash} and every chapter file is a hardlink to its blob.
+{path}/index.jsonl maps every hash to the files linked to it, one {"hash", "size", "path"} line per link.
+Usage: python dedup.py <store path> [--prune] prints the hashes linked from more than one file'''
+from time import perf_counter
+from storage import CHUNK_SIZE, SPOOL_SIZE
+import argparse
+import asyncio
+import glob
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+
+class BlobStore:
+    '''Blobs and their hash -> paths index, stats counts hits (already stored), misses and bytes not written'''
+    filename = 'index.jsonl'
+
+    def __init__(self, path, algorithm='sha256'):
+        self.path = path
+        self.algorithm = algorithm
+        # paths in the index are relative to the directory holding the store, the --path of the scraper
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.index = {}
+        self.paths = {}
+        self.writing = {}
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'copies': 0}
+        self.parts = itertools.count()
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, self.filename)
+        if os.path.isfile(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        continue
+        self.file = open(index_path, 'a', encoding='utf-8')
+
+    def apply(self, record):
+        previous = self.paths.get(record['path'])
+        if previous is not None and previous != record['hash'] and previous in self.index:
+            self.index[previous]['paths'].discard(record['path'])
+        self.paths[record['path']] = record['hash']
+        entry = self.index.setdefault(record['hash'], {'size': record['size'], 'paths': set()})
+        entry['paths'].add(record['path'])
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    async def write(self, response, path, chunk_size=CHUNK_SIZE, metrics=None):
+        '''
+        Hashes the aiohttp response body while spooling it, writes it as a blob only if the hash is new,
+        then atomically links path to the blob. Returns the number of bytes of the image
+        '''
+        digest = hashlib.new(self.algorithm)
+        size = 0
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            digest = digest.hexdigest()
+            blob = self.blob_path(digest)
+            start = perf_counter()
+            if digest in self.writing:
+                # the same image is being written by another download, link to its blob once it's done
+                await asyncio.shield(self.writing[digest])
+            if os.path.isfile(blob):
+                self.stats['hits'] += 1
+                self.stats['bytes_saved'] += size
+            else:
+                self.stats['misses'] += 1
+                spool.seek(0)
+                self.writing[digest] = asyncio.get_running_loop().create_future()
+                try:
+                    await self.write_blob(spool, blob, chunk_size)
+                finally:
+                    self.writing.pop(digest).set_result(None)
+                if metrics is not None:
+                    metrics.add_bytes(size)
+        self.link(blob, path)
+        if metrics is not None:
+            metrics.observe('write', perf_counter() - start)
+        self.add(digest, size, path)
+        return size
+
+    async def write_blob(self, spool, blob, chunk_size):
+        import aiofiles
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        # other processes sharing the store write their own part of the same image, the last rename wins
+        part = f"{blob}.{os.getpid()}.{next(self.parts)}.part"
+        try:
+            async with aiofiles.open(part, 'wb') as aiof:
+                for chunk in iter(lambda: spool.read(chunk_size), b''):
+                    await aiof.write(chunk)
+            os.replace(part, blob)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+
+    def link(self, blob, path):
+        '''Points path at blob with a hardlink, copying the blob where the filesystem can't link'''
+        part = f"{path}.part"
+        if os.path.exists(part):
+            os.remove(part)
+        try:
+            os.link(blob, part)
+        except OSError:
+            shutil.copyfile(blob, part)
+            self.stats['copies'] += 1
+        os.replace(part, path)
+
+    def add(self, digest, size, path):
+        record = {'hash': digest, 'size': size, 'path': os.path.relpath(os.path.abspath(path), self.root)}
+        if self.paths.get(record['path']) != digest:
+            self.apply(record)
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def duplicates(self):
+        '''{hash: sorted paths} of the blobs linked from more than one path'''
+        return {digest: sorted(entry['paths']) for digest, entry in self.index.items() if len(entry['paths']) > 1}
+
+    def metrics(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return dict(self.stats, blobs=len(self.index),
+                    hit_ratio=round(self.stats['hits'] / lookups, 3) if lookups else 0.0)
+
+    def prune(self):
+        '''Removes blobs no file links to anymore and rewrites the index without them, returning the bytes freed'''
+        freed = 0
+        for blob in glob.glob(os.path.join(self.path, '??', '*')):
+            if not blob.endswith('.part') and os.stat(blob).st_nlink == 1:
+                freed += os.path.getsize(blob)
+                os.remove(blob)
+                self.index.pop(os.path.basename(blob), None)
+        index_path = os.path.join(self.path, self.filename)
+        self.file.close()
+        with open(f"{index_path}.tmp", 'w', encoding='utf-8') as f:
+            for digest, entry in self.index.items():
+                for path in sorted(entry['paths']):
+                    f.write(json.dumps({'hash': digest, 'size': entry['size'], 'path': path}) + '\n')
+        os.replace(f"{index_path}.tmp", index_path)
+        self.file = open(index_path, 'a', encoding='utf-8')
+        return freed
+
+    def close(self):
+        self.file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='the blob store, blobs under the --path of asyncborutov2 --dedup')
+    parser.add_argument('--prune', action='store_true', help='remove blobs no downloaded file links to')
+    args = parser.parse_args()
+
+    store = BlobStore(args.path)
+    for digest, paths in store.duplicates().items():
+        print(f"{digest} {store.index[digest]['size']} bytes x{len(paths)}")
+        for path in paths:
+            print(f"    {path}")
+    saved = sum(entry['size'] * (len(entry['paths']) - 1) for entry in store.index.values())
+    print(f"{len(store.index)} blobs, {sum(len(entry['paths']) for entry in store.index.values())} files, "
+          f"{saved} bytes saved")
+    if args.prune:
+        print(f"Pruned {store.prune()} bytes")
+    store.close()
@@ -0,0 +1,186 @@
+'''Coordinator/worker mode, for backfills bigger than one host's bandwidth and core.
+The coordinator works out the pending chapters of every series and publishes them to a jobqueue.JobQueue.
+Workers, on any host that shares --path and the queue file, lease chapter jobs (requesting the page count
+and publishing a page job per missing page) and page jobs (parsing the page and downloading its image into
+the shared storage and manifest). What fails is recorded on its job instead of each process' error.log,
+the coordinator writes the failures of the whole run to error.log once the queue drains'''
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import os
+import socket
+
+from retry import PERMANENT
+
+
+def fields(series):
+    '''The dict a worker rebuilds series from with MangaClient.series'''
+    return {'directory': series.directory, 'endpoint': series.base_endpoint,
+            'image_name': series.image_name, 'creator': series.creator}
+
+
+class Coordinator:
+    '''Publishes the pending chapters of series to queue and reports on the workers until the queue drains'''
+
+    def __init__(self, client, queue, poll=5):
+        self.client = client
+        self.queue = queue
+        self.poll = poll
+
+    async def run(self, series, wait=True):
+        pending = await asyncio.gather(*(self.client.pending_chapters(entry) for entry in series),
+                                       return_exceptions=True)
+        for entry, chapters in zip(series, pending):
+            if isinstance(chapters, Exception):
+                print(f'{entry.directory}: skipped, {chapters}')
+                continue
+            if not chapters:
+                print(f'{entry.directory}: No new chapters yet, check again at 20th of every month')
+            for chapter in chapters:
+                entry.manifest.queue_chapter(chapter)
+                self.queue.publish('chapter', fields(entry), chapter)
+            print(f"{entry.directory}: published chapters {chapters}")
+        if wait:
+            await self.wait(series)
+
+    async def wait(self, series):
+        '''Prints the job counts every poll seconds until no job is pending or leased, then collects the failures'''
+        counts = None
+        while self.queue.unfinished():
+            if self.queue.counts() != counts:
+                counts = self.queue.counts()
+                print(f"jobs: {counts}")
+            await asyncio.sleep(self.poll)
+        print(f"jobs: {self.queue.counts()}")
+        # Series.close writes them to error.log
+        for entry in series:
+            entry.retry.failures += self.queue.failures(entry.directory)
+
+
+class Worker:
+    '''
+    Runs concurrency jobs of queue at a time with client, until no job is pending or leased.
+    One coroutine leases as many jobs as there are idle workers, waiting poll seconds when every unfinished job
+    is leased by someone else (their leases might expire). Every queue call runs in one thread of its own,
+    so waiting on a queue file busy with other hosts never blocks the transfers on the event loop
+    '''
+
+    def __init__(self, client, queue, concurrency=25, poll=2, name=None):
+        self.client = client
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll = poll
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.series = {}
+        self.done = 0
+        self.held = 0
+        self.freed = None
+        self.executor = None
+
+    def get_series(self, job):
+        '''The Series of job, created once per directory'''
+        directory = job['series']['directory']
+        if directory not in self.series:
+            self.series[directory] = self.client.series(job['series'])
+        return self.series[directory]
+
+    async def run(self):
+        session = self.client.sessions.session()
+        self.executor = ThreadPoolExecutor(1)
+        self.freed = asyncio.Event()
+        jobs = asyncio.Queue()
+        workers = [asyncio.ensure_future(self.work(session, jobs)) for _ in range(self.concurrency)]
+        try:
+            await self.lease(jobs)
+            await jobs.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.executor.shutdown()
+        print(f"{self.name}: finished {self.done} jobs")
+
+    async def call(self, method, *args, **kwargs):
+        '''Awaits self.queue.method(*args, **kwargs) in the queue thread'''
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(getattr(self.queue, method), *args, **kwargs))
+
+    async def lease(self, jobs):
+        '''Keeps jobs filled with leased jobs for the idle workers, until nothing is pending or leased'''
+        while True:
+            self.freed.clear()
+            if self.held < self.concurrency:
+                leased = await self.call('lease_jobs', self.name, self.concurrency - self.held)
+                self.held += len(leased)
+                for job in leased:
+                    jobs.put_nowait(job)
+                if leased:
+                    continue
+                if not self.held and not await self.call('unfinished'):
+                    return
+            # until a worker is free (and might have published page jobs), or leases of other hosts might expire
+            try:
+                await asyncio.wait_for(self.freed.wait(), self.poll)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self, session, jobs):
+        while True:
+            job = await jobs.get()
+            try:
+                await self.handle(session, job)
+            finally:
+                self.held -= 1
+                self.freed.set()
+                jobs.task_done()
+
+    async def handle(self, session, job):
+        '''Runs job and reports it to the queue'''
+        series = self.get_series(job)
+        try:
+            handler = self.chapter if job['kind'] == 'chapter' else self.page
+            failure = await handler(session, series, job)
+        except Exception as e:
+            failure = {'kind': PERMANENT, 'error': repr(e)}
+        if failure is None:
+            finished = await self.call('complete', job, self.name)
+            self.done += finished
+        else:
+            finished = await self.call('fail', job, self.name, failure['error'], retry=failure['kind'] != PERMANENT)
+        if not finished:
+            print(f"{self.name}: lease of {job['kind']} job {job['id']} expired before it finished")
+
+    def failure(self, series, url):
+        '''Takes the failure record of url out of series.retry, it belongs to the job now'''
+        for record in reversed(series.retry.failures):
+            if record['url'] == url:
+                series.retry.failures.remove(record)
+                return record
+        return {'kind': PERMANENT, 'error': f"{url} failed"}
+
+    async def chapter(self, session, series, job):
+        '''Requests the page count of the chapter and publishes a job for every page not stored yet'''
+        chapter = job['chapter']
+        url = f"{series.manga_url}/{chapter}/1"
+        pages = await series.retry.call(url, self.client.chapter_pages, session, series, chapter)
+        if pages is None:
+            if url in series.errors:
+                series.errors.remove(url)
+                return {'kind': PERMANENT, 'error': 'chapter not found'}
+            return self.failure(series, url)
+        series.manifest.set_pages(chapter, pages)
+        self.client.open_chapter(series, chapter)
+        # checked against the shared storage, other workers' pages aren't in this process' manifest
+        for page in self.client.reconcile(series, chapter):
+            await self.call('publish', 'page', job['series'], chapter, page)
+
+    async def page(self, session, series, job):
+        '''Parses the page and downloads its image'''
+        url = f"{series.manga_url}/{job['chapter']}/{job['page']}"
+        found = await series.retry.call(url, self.client.parse_page, session, url)
+        if found is None:
+            return self.failure(series, url)
+        chapter, page_number, img_url = found
+        self.client.open_chapter(series, job['chapter'])
+        if not await series.retry.call(img_url, self.client.save_image, session, series, chapter, page_number, img_url):
+            return self.failure(series, img_url)
@@ -0,0 +1,121 @@
+'''Extracts the image url (div#imgholder img[src]) and the chapter page count (div#selectpage)
+out of a mangareader page.
+The regex extractor scans only until the target is found instead of building a whole tree,
+BeautifulSoup is kept as the fallback for markup the regexes don't understand, and only imported then'''
+import itertools
+import re
+
+
+class ExtractionError(Exception):
+    '''Raised when an extractor can't find its target in the html'''
+
+
+def trailing_number(text):
+    '''Returns the last integer in text, selectpage text ends with "of <total pages>"'''
+    match = re.search(r'(\d+)\s*$', text)
+    if not match:
+        raise ExtractionError(f"No page count in {text[-40:]!r}")
+    return int(match.group(1))
+
+
+class SoupExtractor:
+    '''Builds the full BeautifulSoup tree, slow but tolerant'''
+    name = 'soup'
+
+    def image_url(self, html):
+        from bs4 import BeautifulSoup
+        try:
+            return BeautifulSoup(html, 'html.parser').findAll("div", attrs={"id": "imgholder"})[0].img["src"]
+        except (IndexError, TypeError, KeyError) as e:
+            raise ExtractionError(f"No div#imgholder img[src]: {e!r}")
+
+    def total_pages(self, html):
+        from bs4 import BeautifulSoup
+        try:
+            text = BeautifulSoup(html, 'html.parser').findAll('div', {'id': 'selectpage'})[0].text
+        except IndexError:
+            raise ExtractionError("No div#selectpage")
+        return trailing_number(text)
+
+
+class RegexExtractor:
+    '''
+    Precompiled regexes that stop at the first match. The image has to come before the first </div>
+    after div#imgholder, so a page without one fails instead of matching an img further down
+    '''
+    name = 'regex'
+    image_re = re.compile(
+        r'''<div\b[^>]*\bid\s*=\s*["']?imgholder\b[^>]*>(?:(?!</div>).)*?<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']''',
+        re.IGNORECASE | re.DOTALL)
+    selectpage_re = re.compile(
+        r'''<div\b[^>]*\bid\s*=\s*["']?selectpage\b[^>]*>(.*?)</div>''',
+        re.IGNORECASE | re.DOTALL)
+    tag_re = re.compile(r'<[^>]*>')
+
+    def image_url(self, html):
+        match = self.image_re.search(html)
+        if not match:
+            raise ExtractionError("No div#imgholder img[src]")
+        return match.group(1)
+
+    def total_pages(self, html):
+        match = self.selectpage_re.search(html)
+        if not match:
+            raise ExtractionError("No div#selectpage")
+        return trailing_number(self.tag_re.sub('', match.group(1)))
+
+
+class FallbackExtractor:
+    '''Tries each extractor in order, returning the first successful result'''
+    name = 'auto'
+
+    def __init__(self, *extractors):
+        self.extractors = extractors
+
+    def image_url(self, html):
+        return self.first('image_url', html)
+
+    def total_pages(self, html):
+        return self.first('total_pages', html)
+
+    def first(self, method, html):
+        errors = []
+        for extractor in self.extractors:
+            try:
+                return getattr(extractor, method)(html)
+            except ExtractionError as e:
+                errors.append(f"{extractor.name}: {e}")
+        raise ExtractionError('; '.join(errors))
+
+
+extractors = {
+    'auto': FallbackExtractor(RegexExtractor(), SoupExtractor()),
+    'regex': RegexExtractor(),
+    'soup': SoupExtractor(),
+}
+
+
+UL_RE = re.compile(r'<ul\b', re.IGNORECASE)
+HREF_RE = re.compile(r'''<a\b[^>]*?\bhref\s*=\s*["']([^"']+)["']''', re.IGNORECASE)
+
+
+def latest_chapter(html):
+    '''
+    Number of the latest chapter on a manga index page, the first link of its third <ul>.
+    Same as BeautifulSoup's findAll('ul')[2].findAll('a')[0]['href'] without building the tree
+    '''
+    starts = [match.start() for match in itertools.islice(UL_RE.finditer(html), 3)]
+    if len(starts) < 3:
+        raise ExtractionError("No third <ul> on the index")
+    match = HREF_RE.search(html, starts[2])
+    if not match:
+        raise ExtractionError("No link after the third <ul> on the index")
+    try:
+        return int(match.group(1).rstrip('/').split('/')[-1])
+    except ValueError:
+        raise ExtractionError(f"No chapter number in {match.group(1)!r}")
+
+
+def extract(name, method, html):
+    '''Module level entry point, picklable for ProcessPoolExecutor: extractors[name].method(html)'''
+    return getattr(extractors[name], method)(html)
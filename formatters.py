@@ -0,0 +1,15 @@
+'''Formatting of names scraped from mangareader into names usable as directories and files'''
+import re
+
+# not allowed in windows file names, plus control characters
+INVALID_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+def char_remover(value):
+    '''
+    Removes the characters that can't be in a file name from value, a string
+    or a catalog.Entry, whose Name is cleaned and every other field left as is
+    '''
+    if hasattr(value, '_replace'):
+        return value._replace(Name=char_remover(value.Name))
+    return ' '.join(INVALID_RE.sub('', value).split()).rstrip('. ')
@@ -0,0 +1,154 @@
+'''SQLite backed queue of chapter and page jobs shared by the processes of a distributed run.
+Workers lease jobs for a while, a job whose lease expires before it's completed goes back to the queue.
+Jobs that fail too often stay in the table as failure records, replacing the per process error lists.
+Every process opens the same file, so it has to be on a filesystem where SQLite locking works.
+A queue at ':memory:' is the local stand-in, python jobqueue.py --check runs the lease rules against one.
+Usage: python jobqueue.py [QUEUE] [--check] prints the job counts and failures of QUEUE'''
+from time import time, localtime, strftime, sleep
+import argparse
+import json
+import sqlite3
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    '''
+    Jobs are (kind, series, chapter, page) with series a dict of the series fields, unique per kind, series
+    directory, chapter and page. A job runs at most attempts times, each lease being one attempt
+    '''
+
+    def __init__(self, path, lease=300, attempts=3):
+        self.path = path
+        self.lease = lease
+        self.attempts = attempts
+        # usable from a thread other than the one creating it, like the one distributed.Worker runs every call in
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY, kind TEXT, directory TEXT, series TEXT, chapter INTEGER, page INTEGER,
+            state TEXT, attempts INTEGER DEFAULT 0, worker TEXT, expires REAL, error TEXT, updated REAL,
+            UNIQUE (kind, directory, chapter, page))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, expires)')
+
+    def publish(self, kind, series, chapter, page=0):
+        '''Queues a job, or queues it again if it already finished'''
+        self.db.execute('''INSERT INTO jobs (kind, directory, series, chapter, page, state, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (kind, directory, chapter, page) DO UPDATE
+            SET state = excluded.state, attempts = 0, error = NULL, updated = excluded.updated
+            WHERE state IN (?, ?)''',
+                        (kind, series['directory'], json.dumps(series), chapter, page, PENDING, time(), DONE, FAILED))
+
+    def lease_jobs(self, worker, count=1):
+        '''
+        Leases up to count pending (or expired) jobs to worker, as dicts with id, kind, series, chapter,
+        page and attempts. Expired jobs that used up their attempts are failed instead
+        '''
+        now = time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('''UPDATE jobs SET state = ?, error = 'lease expired', updated = ?
+                WHERE state = ? AND expires < ? AND attempts >= ?''', (FAILED, now, LEASED, now, self.attempts))
+            rows = self.db.execute('''SELECT id, kind, series, chapter, page, attempts FROM jobs
+                WHERE state = ? OR (state = ? AND expires < ?) ORDER BY kind, id LIMIT ?''',
+                                   (PENDING, LEASED, now, count)).fetchall()
+            for row in rows:
+                self.db.execute('''UPDATE jobs SET state = ?, worker = ?, expires = ?, attempts = attempts + 1,
+                    updated = ? WHERE id = ?''', (LEASED, worker, now + self.lease, now, row[0]))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return [{'id': id, 'kind': kind, 'series': json.loads(series), 'chapter': chapter, 'page': page,
+                 'attempts': attempts + 1} for id, kind, series, chapter, page, attempts in rows]
+
+    def complete(self, job, worker):
+        '''
+        Marks job done, if worker still holds its lease. Returns False when the lease expired
+        and the job went back to the queue or to another worker
+        '''
+        return self.db.execute('''UPDATE jobs SET state = ?, error = NULL, updated = ?
+            WHERE id = ? AND worker = ? AND state = ?''', (DONE, time(), job['id'], worker, LEASED)).rowcount == 1
+
+    def fail(self, job, worker, error, retry=True):
+        '''
+        Puts job back in the queue, or records it as failed when retry is False or it's out of attempts,
+        if worker still holds its lease. Returns False otherwise, like complete
+        '''
+        state = PENDING if retry and job['attempts'] < self.attempts else FAILED
+        return self.db.execute('''UPDATE jobs SET state = ?, error = ?, updated = ?
+            WHERE id = ? AND worker = ? AND state = ?''',
+                               (state, error, time(), job['id'], worker, LEASED)).rowcount == 1
+
+    def counts(self):
+        '''{state: number of jobs}'''
+        return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def unfinished(self):
+        '''Jobs pending or leased'''
+        return self.db.execute('SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)', (PENDING, LEASED)).fetchone()[0]
+
+    def failures(self, directory=None):
+        '''Failure records of the failed jobs, of one series directory if given'''
+        query = 'SELECT kind, directory, chapter, page, attempts, worker, error, updated FROM jobs WHERE state = ?'
+        args = (FAILED,)
+        if directory is not None:
+            query += ' AND directory = ?'
+            args += (directory,)
+        return [{'kind': kind, 'series': directory, 'chapter': chapter, 'page': page or None, 'attempts': attempts,
+                 'worker': worker, 'error': error, 'time': strftime('%d/%m/%Y %H:%M:%S', localtime(updated))}
+                for kind, directory, chapter, page, attempts, worker, error, updated in self.db.execute(query, args)]
+
+    def close(self):
+        self.db.close()
+
+
+def expect(condition, message):
+    '''assert that still checks under python -O'''
+    if not condition:
+        raise AssertionError(message)
+
+
+def check():
+    '''Runs lease expiry, stale completions and attempt exhaustion against an in memory queue'''
+    queue = JobQueue(':memory:', lease=0.05, attempts=2)
+    queue.publish('chapter', {'directory': 'Naruto'}, 1)
+    first = queue.lease_jobs('a')[0]
+    expect(queue.lease_jobs('b') == [], 'a leased job was leased twice')
+    sleep(0.06)
+    second = queue.lease_jobs('b')[0]
+    expect(second['id'] == first['id'] and second['attempts'] == 2, 'an expired lease was not handed out again')
+    expect(not queue.complete(first, 'a') and not queue.fail(first, 'a', 'late'), 'a stale worker changed the job')
+    expect(queue.counts() == {LEASED: 1}, f"expected 1 leased job, got {queue.counts()}")
+    sleep(0.06)
+    expect(queue.lease_jobs('c') == [], 'a job out of attempts was leased')
+    expect(queue.counts() == {FAILED: 1} and queue.failures()[0]['error'] == 'lease expired',
+           'an expired job out of attempts was not failed')
+    queue.publish('chapter', {'directory': 'Naruto'}, 1)
+    job = queue.lease_jobs('c')[0]
+    expect(queue.fail(job, 'c', 'HTTPStatusError(503)') and queue.counts() == {PENDING: 1}, 'a retry was dropped')
+    job = queue.lease_jobs('c')[0]
+    expect(queue.fail(job, 'c', 'HTTPStatusError(503)') and queue.counts() == {FAILED: 1}, 'attempts ran over')
+    expect(queue.lease_jobs('c') == [] and queue.unfinished() == 0, 'a failed job is still unfinished')
+    queue.close()
+    print('ok')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', help='the job queue of asyncborutov2 --coordinator/--worker')
+    parser.add_argument('--check', action='store_true', help='run the lease rules against an in memory queue')
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+    if args.path:
+        queue = JobQueue(args.path)
+        print(f"jobs: {queue.counts()}")
+        for failure in queue.failures():
+            print(f"{failure['series']} {failure['kind']} {failure['chapter']}"
+                  f"{'/' + str(failure['page']) if failure['page'] else ''} after {failure['attempts']} attempts "
+                  f"on {failure['worker']}: {failure['error']}")
+        queue.close()
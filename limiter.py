@@ -0,0 +1,115 @@
+'''AIMD adaptive concurrency limits per host.
+Every host gets its own limit of in-flight requests, raised by one for every limit successful responses
+(additive increase) and halved on a 429, 5xx, connection error or a latency spike (multiplicative decrease).
+Decreases happen at most once per observed latency, so one burst of errors doesn't collapse the limit'''
+from urllib.parse import urlparse
+from time import perf_counter
+import asyncio
+
+
+class HostLimiter:
+    '''Adaptive limit of in-flight requests to a single host'''
+
+    def __init__(self, initial=8, minimum=1, maximum=50, decrease=0.5, tolerance=3.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.latency = None
+        self.base_latency = None
+        self.last_decrease = 0
+        self.counts = {'requests': 0, 'throttled': 0, 'errors': 0, 'slow': 0}
+        self.condition = None
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, status=None, latency=None, error=False):
+        '''Frees the slot and adapts the limit. status and latency are None when no request was made'''
+        self.in_flight -= 1
+        if error or status is not None:
+            self.adapt(status, latency, error)
+        async with self.condition:
+            self.condition.notify_all()
+
+    def adapt(self, status, latency, error):
+        self.counts['requests'] += 1
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.base_latency = self.latency if self.base_latency is None else min(self.base_latency, self.latency)
+        if error or status >= 500:
+            self.counts['errors'] += 1
+            self.backoff()
+        elif status == 429:
+            self.counts['throttled'] += 1
+            self.backoff()
+        elif self.latency is not None and self.latency > self.tolerance * self.base_latency:
+            self.counts['slow'] += 1
+            self.backoff()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def backoff(self):
+        now = perf_counter()
+        if now - self.last_decrease > (self.latency or 0):
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self.last_decrease = now
+
+    def metrics(self):
+        return dict(self.counts, limit=int(self.limit), in_flight=self.in_flight,
+                    latency=round(self.latency, 3) if self.latency is not None else None)
+
+
+class Slot:
+    '''Held while a request is in flight, call slot.response(status) once the headers arrive'''
+
+    def __init__(self, host_limiter):
+        self.host_limiter = host_limiter
+        self.status = None
+        self.latency = None
+
+    async def __aenter__(self):
+        await self.host_limiter.acquire()
+        self.start = perf_counter()
+        return self
+
+    def response(self, status):
+        self.status = status
+        self.latency = perf_counter() - self.start
+
+    async def __aexit__(self, exc_type, exc, tb):
+        error = exc_type is not None and issubclass(exc_type, Exception) and self.status is None
+        await self.host_limiter.release(self.status, self.latency, error)
+
+
+class AdaptiveLimiter:
+    '''
+    One HostLimiter per host, html_host gets the html budget and every other host (the image CDN shards)
+    gets the image budget. Budgets are dicts of HostLimiter keyword arguments
+    '''
+
+    def __init__(self, html_host, html_budget=None, image_budget=None):
+        self.html_host = html_host
+        self.html_budget = html_budget or {}
+        self.image_budget = image_budget or {}
+        self.hosts = {}
+
+    def host(self, url):
+        host = urlparse(url).netloc
+        if host not in self.hosts:
+            budget = self.html_budget if host == self.html_host else self.image_budget
+            self.hosts[host] = HostLimiter(**budget)
+        return self.hosts[host]
+
+    def request(self, url):
+        '''async with limiter.request(url) as slot: ...'''
+        return Slot(self.host(url))
+
+    def metrics(self):
+        return {host: limiter.metrics() for host, limiter in self.hosts.items()}
@@ -0,0 +1,131 @@
+'''Append-only JSONL index of what has been downloaded for a series, kept at {base_path}/manifest.jsonl.
+Each line is either a chapter record {"chapter": 5, "pages": 17} ({"chapter": 5} once it's queued,
+{"chapter": 5, "not_found": true} when it 404s) or a page record {"chapter": 5, "page": 3, "size": 81234, "url": "https://..."}.
+Resume lookups are answered from memory instead of re-globbing the output tree'''
+import glob
+import json
+import os
+import re
+
+
+class Manifest:
+    '''In memory view of manifest.jsonl, appending a line for every change'''
+    filename = 'manifest.jsonl'
+    chapter_re = re.compile(r'^Chapter (\d+)$')
+    page_re = re.compile(r'\.ch(\d+)\.p(\d+)\.jpg$')
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.path = os.path.join(base_path, self.filename)
+        self.chapters = {}
+        self.max_chapter = None
+        exists = os.path.isfile(self.path)
+        if exists:
+            self.load()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if not exists:
+            self.scan()
+
+    def load(self):
+        '''Replays every record of manifest.jsonl, ignoring a torn last line'''
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.apply(record)
+
+    def scan(self):
+        '''Builds the manifest from an existing download directory, only run once when there is no manifest yet'''
+        for chapter_path in glob.glob(os.path.join(self.base_path, '*/')):
+            match = self.chapter_re.match(os.path.basename(os.path.dirname(chapter_path)))
+            if not match:
+                continue
+            chapter = int(match.group(1))
+            self.write({'chapter': chapter})
+            for image in glob.glob(os.path.join(chapter_path, '*.jpg')):
+                match = self.page_re.search(image)
+                if match and int(match.group(1)) == chapter:
+                    self.write({'chapter': chapter, 'page': int(match.group(2)),
+                                'size': os.path.getsize(image), 'url': None})
+
+    def apply(self, record):
+        chapter = self.chapters.setdefault(record['chapter'], {'pages': None, 'done': {}})
+        if 'page' in record:
+            if record.get('removed'):
+                chapter['done'].pop(record['page'], None)
+            else:
+                chapter['done'][record['page']] = {'size': record.get('size'), 'url': record.get('url')}
+        elif record.get('pages') is not None:
+            chapter['pages'] = record['pages']
+        elif record.get('not_found'):
+            chapter['not_found'] = True
+        if self.max_chapter is None or record['chapter'] > self.max_chapter:
+            self.max_chapter = record['chapter']
+
+    def write(self, record):
+        self.apply(record)
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def set_pages(self, chapter, pages):
+        '''Records the total pages of chapter'''
+        if self.chapters.get(chapter, {}).get('pages') != pages:
+            self.write({'chapter': chapter, 'pages': pages})
+
+    def queue_chapter(self, chapter):
+        '''Records chapter before its page count is known, so it's retried if the count never arrives'''
+        if chapter not in self.chapters:
+            self.write({'chapter': chapter})
+
+    def not_found(self, chapter):
+        '''Records that chapter doesn't exist upstream, it's never downloaded again'''
+        if not self.chapters.get(chapter, {}).get('not_found'):
+            self.write({'chapter': chapter, 'not_found': True})
+
+    def add_page(self, chapter, page, size, url=None):
+        '''Records that page of chapter is on disk'''
+        self.write({'chapter': chapter, 'page': page, 'size': size, 'url': url})
+
+    def remove_page(self, chapter, page):
+        '''Forgets page of chapter, so it's downloaded again'''
+        if page in self.done(chapter):
+            self.write({'chapter': chapter, 'page': page, 'removed': True})
+
+    @property
+    def last_chapter(self):
+        '''Highest chapter seen, or 1 when nothing was downloaded yet'''
+        return self.max_chapter if self.max_chapter is not None else 1
+
+    def last_page(self, chapter):
+        '''Highest page downloaded of chapter, or 1 when none'''
+        done = self.chapters.get(chapter, {}).get('done')
+        return max(done) if done else 1
+
+    def pages(self, chapter):
+        '''Total pages of chapter, or None if unknown'''
+        return self.chapters.get(chapter, {}).get('pages')
+
+    def done(self, chapter):
+        '''Dict of {page: {'size', 'url'}} downloaded for chapter'''
+        return self.chapters.get(chapter, {}).get('done', {})
+
+    def missing(self, chapter):
+        '''Pages of chapter not downloaded yet, or None if the page count is unknown'''
+        pages = self.pages(chapter)
+        if pages is None:
+            return None
+        done = self.done(chapter)
+        return [page for page in range(1, pages + 1) if page not in done]
+
+    def incomplete(self, chapter):
+        '''Whether chapter still has missing pages or an unknown page count, unless it 404'd'''
+        return not self.chapters.get(chapter, {}).get('not_found') and self.missing(chapter) != []
+
+    def incomplete_chapters(self):
+        '''Recorded chapters that are incomplete'''
+        return sorted(chapter for chapter in self.chapters if self.incomplete(chapter))
+
+    def close(self):
+        self.file.close()
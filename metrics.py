@@ -0,0 +1,170 @@
+'''Counters, latency histograms and gauges per pipeline stage, replacing per request print() as instrumentation.
+Snapshots can be served as Prometheus text on an http port, or written periodically to a json file'''
+from contextlib import contextmanager
+from time import perf_counter, time
+from http import HTTPStatus
+import asyncio
+import bisect
+import json
+import os
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# for stages taking minutes, like a whole chapter
+LONG_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600)
+
+
+class Histogram:
+    '''Cumulative latency histogram with Prometheus style buckets'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q quantile'''
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': round(self.sum, 4),
+                'mean': round(self.sum / self.count, 4) if self.count else None,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    '''
+    Per stage (index, page, image, write) request/error counters, latency histograms and in flight gauges,
+    plus bytes written. sources maps a name to a callable returning a dict of extra gauges (limiter, connections)
+    '''
+
+    def __init__(self, sources=None):
+        self.sources = sources or {}
+        self.started = perf_counter()
+        self.requests = {}
+        self.errors = {}
+        self.in_flight = {}
+        self.histograms = {}
+        self.bytes = 0
+
+    @contextmanager
+    def time(self, stage):
+        '''with metrics.time('page'): ... counts, times and tracks the in flight requests of stage'''
+        self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+        start = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+            raise
+        finally:
+            self.in_flight[stage] -= 1
+            self.observe(stage, perf_counter() - start)
+
+    def observe(self, stage, seconds, buckets=BUCKETS):
+        '''Counts and times one request of stage, buckets only matter the first time stage is observed'''
+        self.requests[stage] = self.requests.get(stage, 0) + 1
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram(buckets)
+        self.histograms[stage].observe(seconds)
+
+    def add_bytes(self, size):
+        self.bytes += size
+
+    def snapshot(self):
+        elapsed = perf_counter() - self.started
+        return {
+            'time': time(),
+            'elapsed': round(elapsed, 2),
+            'bytes': self.bytes,
+            'bytes_per_sec': round(self.bytes / elapsed, 1) if elapsed else 0,
+            'stages': {stage: dict(histogram.snapshot(), errors=self.errors.get(stage, 0),
+                                   in_flight=self.in_flight.get(stage, 0))
+                       for stage, histogram in self.histograms.items()},
+            **{name: source() for name, source in self.sources.items()},
+        }
+
+    def prometheus(self):
+        '''Current metrics in the Prometheus text exposition format'''
+        lines = ['# TYPE scraper_requests_total counter']
+        lines += [f'scraper_requests_total{{stage="{stage}"}} {count}' for stage, count in self.requests.items()]
+        lines.append('# TYPE scraper_errors_total counter')
+        lines += [f'scraper_errors_total{{stage="{stage}"}} {count}' for stage, count in self.errors.items()]
+        lines.append('# TYPE scraper_in_flight gauge')
+        lines += [f'scraper_in_flight{{stage="{stage}"}} {count}' for stage, count in self.in_flight.items()]
+        lines.append('# TYPE scraper_latency_seconds histogram')
+        for stage, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'scraper_latency_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'scraper_latency_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'scraper_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+        snapshot = self.snapshot()
+        lines.append('# TYPE scraper_bytes_total counter')
+        lines.append(f'scraper_bytes_total {self.bytes}')
+        lines.append('# TYPE scraper_bytes_per_second gauge')
+        lines.append(f'scraper_bytes_per_second {snapshot["bytes_per_sec"]}')
+        for name in self.sources:
+            lines += self.gauges(f'scraper_{name}', snapshot[name])
+        return '\n'.join(lines) + '\n'
+
+    def gauges(self, prefix, values, labels=''):
+        '''Flattens a source dict into gauges, nested dicts (per host) become a key label'''
+        lines = []
+        for key, value in values.items():
+            if isinstance(value, dict):
+                lines += self.gauges(prefix, value, f'key="{key}"')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'{prefix}_{key}{{{labels}}} {value}' if labels else f'{prefix}_{key} {value}')
+        return lines
+
+    async def serve(self, port, host='127.0.0.1', routes=None):
+        '''
+        Serves self.prometheus() to any http GET on port until cancelled, only on localhost unless host says otherwise.
+        routes maps other paths to callables returning (status, content type, body)
+        '''
+        async def handle(reader, writer):
+            try:
+                request = await reader.readuntil(b'\r\n\r\n')
+                path = request.split(b' ', 2)[1].decode(errors='replace').split('?')[0] if b' ' in request else '/'
+                route = (routes or {}).get(path)
+                status, content_type, body = route() if route else (200, 'text/plain; version=0.0.4', self.prometheus())
+                body = body.encode()
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s'
+                             % (status, HTTPStatus(status).phrase.encode(), content_type.encode(), len(body), body))
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                # the client hung up or sent something that isn't an http request
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def write_snapshots(self, path, interval=10):
+        '''Atomically rewrites path with self.snapshot() every interval seconds until cancelled'''
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.write_snapshot(path)
+        finally:
+            self.write_snapshot(path)
+
+    def write_snapshot(self, path):
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,79 @@
+'''Bounded retries with capped exponential backoff and full jitter.
+Errors are classified as retryable (connection errors, timeouts, 429 and 5xx), parse failures
+(the page came back but had no image or page count, retried a couple of times in case it was an error page)
+or permanent (any other 4xx), which are never retried. Each url has its own attempt budget and
+every url that gives up is kept as a structured record in RetryPolicy.failures'''
+from time import strftime
+import asyncio
+import random
+
+from extractors import ExtractionError
+
+RETRYABLE = 'retryable'
+PARSE = 'parse'
+PERMANENT = 'permanent'
+
+
+def classify(error):
+    '''
+    Returns RETRYABLE, PARSE or PERMANENT for an exception raised while handling a request.
+    Errors with a retry_kind attribute (transform.TransformError) say how they're retried themselves
+    '''
+    if getattr(error, 'retry_kind', None) in (RETRYABLE, PARSE, PERMANENT):
+        return error.retry_kind
+    if isinstance(error, ExtractionError):
+        return PARSE
+    status = getattr(error, 'status', None)
+    if isinstance(status, int):
+        return RETRYABLE if status == 429 or status >= 500 else PERMANENT
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)):
+        return RETRYABLE
+    # aiohttp.ClientError and friends, matched by module so this file doesn't need aiohttp
+    if type(error).__module__.startswith('aiohttp'):
+        return RETRYABLE
+    return PERMANENT
+
+
+class RetryPolicy:
+    '''
+    Runs coroutines with a per key attempt budget, sleeping base * 2 ** attempt (capped, jittered) between attempts.
+    Retries and give ups are reported to log, None to keep quiet (failures are recorded either way)
+    '''
+
+    def __init__(self, attempts=5, parse_attempts=2, base=0.5, cap=30.0, log=print):
+        self.budgets = {RETRYABLE: attempts, PARSE: parse_attempts, PERMANENT: 1}
+        self.base = base
+        self.cap = cap
+        self.log = log
+        self.attempts = {}
+        self.failures = []
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    async def call(self, key, func, *args, **kwargs):
+        '''Awaits func(*args, **kwargs) until it succeeds or key runs out of attempts, returning None in that case'''
+        while True:
+            attempt = self.attempts[key] = self.attempts.get(key, 0) + 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                if attempt >= self.budgets[kind]:
+                    self.give_up(key, kind, e, attempt)
+                    return None
+                delay = self.delay(attempt)
+                if self.log:
+                    self.log(f"{kind} error on {key!r} (attempt {attempt}): {e!r}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            else:
+                self.attempts.pop(key, None)
+                return result
+
+    def give_up(self, key, kind, error, attempts):
+        self.attempts.pop(key, None)
+        record = {'url': key, 'kind': kind, 'error': repr(error), 'attempts': attempts,
+                  'time': strftime('%d/%m/%Y %H:%M:%S')}
+        if self.log:
+            self.log(f"Giving up on {key!r} after {attempts} attempts: {error!r}")
+        self.failures.append(record)
@@ -0,0 +1,131 @@
+'''Scheduling of jobs between series sharing one pipeline, and between the chapters of each series'''
+from collections import OrderedDict
+import asyncio
+import heapq
+import itertools
+
+ROUND_ROBIN = 'round-robin'
+NEWEST_FIRST = 'newest-first'
+COMPLETE_FIRST = 'complete-first'
+POLICIES = (ROUND_ROBIN, NEWEST_FIRST, COMPLETE_FIRST)
+
+
+class FairQueue:
+    '''
+    Drop in replacement for asyncio.Queue holding one queue per key(item).
+    get() takes from the keys with pending items in round robin, so every series gets an equal share
+    of the workers consuming the queue. maxsize bounds each key separately, so one series with a
+    slow stage doesn't block the producers of the others.
+    With a priority, each key's items come out lowest priority(item) first (FIFO among equals),
+    and with fair=False get() skips the rotation and takes the lowest priority item of any key
+    '''
+
+    def __init__(self, key, maxsize=0, priority=None, fair=True):
+        self.key = key
+        self.maxsize = maxsize
+        self.priority = priority
+        self.fair = fair
+        self.queues = OrderedDict()
+        self.counter = itertools.count()
+        self.unfinished = 0
+        self.condition = None
+        # notify() tasks, referenced until they're done so they can't be garbage collected before running
+        self.notifying = set()
+
+    def get_condition(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    def qsize(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def empty(self):
+        return not any(self.queues.values())
+
+    def full(self, key):
+        return 0 < self.maxsize <= len(self.queues.get(key, ()))
+
+    def put_nowait(self, item):
+        key = self.key(item)
+        if self.full(key):
+            raise asyncio.QueueFull
+        priority = self.priority(item) if self.priority else 0
+        heapq.heappush(self.queues.setdefault(key, []), (priority, next(self.counter), item))
+        self.unfinished += 1
+        # wakes up getters already waiting, like asyncio.Queue.put_nowait
+        if self.condition is not None:
+            self.wake()
+
+    async def put(self, item):
+        key = self.key(item)
+        async with self.get_condition():
+            await self.condition.wait_for(lambda: not self.full(key))
+            self.put_nowait(item)
+            self.condition.notify_all()
+
+    def next_key(self):
+        '''
+        First key with pending items, moved to the back of the rotation.
+        Unfair queues take the key whose next item comes first instead
+        '''
+        if not self.fair:
+            return min((queue[0], key) for key, queue in self.queues.items() if queue)[1]
+        for key, queue in self.queues.items():
+            if queue:
+                self.queues.move_to_end(key)
+                return key
+
+    async def get(self):
+        async with self.get_condition():
+            await self.condition.wait_for(lambda: not self.empty())
+            item = heapq.heappop(self.queues[self.next_key()])[-1]
+            self.condition.notify_all()
+            return item
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished == 0 and self.condition is not None:
+            self.wake()
+
+    def wake(self):
+        '''Notifies every waiter once the condition can be taken, from code that can't await'''
+        task = asyncio.ensure_future(self.notify())
+        self.notifying.add(task)
+        task.add_done_callback(self.notifying.discard)
+
+    async def notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def join(self):
+        async with self.get_condition():
+            await self.condition.wait_for(lambda: self.unfinished == 0)
+
+
+class Policy:
+    '''
+    Priorities of the pipeline stages, whose items all start with (series, chapter, ...):
+    round-robin keeps every stage FIFO per series, rotating between series.
+    newest-first takes the highest chapter of each series first, at every stage.
+    complete-first hands out the pages and images of the chapters whose pages started first, across every
+    series, so chapters in flight finish before the next ones get workers
+    '''
+
+    def __init__(self, name=ROUND_ROBIN):
+        if name not in POLICIES:
+            raise ValueError(f"Unknown policy {name!r}, choose one of {', '.join(POLICIES)}")
+        self.name = name
+        self.started = {}
+
+    def queue(self, key, stage, maxsize=0):
+        '''FairQueue for stage ('chapter', 'page' or 'image') of the pipeline'''
+        if self.name == NEWEST_FIRST:
+            return FairQueue(key, maxsize, lambda item: -int(item[1]))
+        if self.name == COMPLETE_FIRST and stage != 'chapter':
+            return FairQueue(key, maxsize, self.start_order, fair=False)
+        return FairQueue(key, maxsize)
+
+    def start_order(self, item):
+        '''Order in which the chapter of item got its first page queued'''
+        return self.started.setdefault((item[0].directory, int(item[1])), len(self.started))
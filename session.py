@@ -0,0 +1,57 @@
+'''One long lived aiohttp ClientSession per run, with a tunable TCPConnector and connection reuse stats.
+aiohttp is only imported with the first session, a run that makes no aiohttp request never loads it'''
+
+
+class SessionFactory:
+    '''
+    Lazily creates a single ClientSession inside the running loop and hands the same one to every caller,
+    so TLS handshakes and DNS lookups are paid once per host instead of once per session.
+    stats counts requests, new connections, reused connections and dns cache hits/misses
+    '''
+
+    def __init__(self, headers=None, limit=100, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=30):
+        self.headers = headers
+        self.connector_options = {'limit': limit, 'limit_per_host': limit_per_host,
+                                  'ttl_dns_cache': ttl_dns_cache, 'keepalive_timeout': keepalive_timeout}
+        self.stats = {'requests': 0, 'connections_created': 0, 'connections_reused': 0,
+                      'dns_cache_hits': 0, 'dns_cache_misses': 0}
+        self._session = None
+
+    def trace_config(self):
+        from aiohttp import TraceConfig
+        trace_config = TraceConfig()
+        for signal, stat in ((trace_config.on_request_start, 'requests'),
+                             (trace_config.on_connection_create_end, 'connections_created'),
+                             (trace_config.on_connection_reuseconn, 'connections_reused'),
+                             (trace_config.on_dns_cache_hit, 'dns_cache_hits'),
+                             (trace_config.on_dns_cache_miss, 'dns_cache_misses')):
+            signal.append(self.counter(stat))
+        return trace_config
+
+    def counter(self, stat):
+        async def count(session, context, params):
+            self.stats[stat] += 1
+        return count
+
+    def session(self):
+        '''The shared ClientSession, created on first use. Must be called from a coroutine'''
+        if self._session is None or self._session.closed:
+            from aiohttp import ClientSession, TCPConnector
+            self._session = ClientSession(headers=self.headers, connector=TCPConnector(**self.connector_options),
+                                          trace_configs=[self.trace_config()])
+        return self._session
+
+    @property
+    def started(self):
+        '''Whether a session was created, so aiohttp is already loaded'''
+        return self._session is not None
+
+    @property
+    def reuse_ratio(self):
+        '''Fraction of requests that went over an already open connection'''
+        used = self.stats['connections_created'] + self.stats['connections_reused']
+        return self.stats['connections_reused'] / used if used else 0.0
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
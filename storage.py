@@ -0,0 +1,275 @@
+'''Writes downloaded images to disk, either as a directory of images per chapter or a cbz archive per chapter'''
+from time import perf_counter
+import asyncio
+import glob
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+# pages bigger than this are spooled to a temporary file before going into a cbz
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+async def write_stream(response, path, chunk_size=CHUNK_SIZE, metrics=None):
+    '''Streams an aiohttp response body into path.part, then atomically renames it to path.
+    Memory stays bounded by chunk_size, and a crash never leaves a truncated file at path.
+    Time spent writing is observed as the 'write' stage of metrics, if given.
+    Returns the number of bytes written'''
+    import aiofiles
+    part = f"{path}.part"
+    size = 0
+    writing = 0.0
+    try:
+        async with aiofiles.open(part, 'wb') as aiof:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                start = perf_counter()
+                await aiof.write(chunk)
+                writing += perf_counter() - start
+                size += len(chunk)
+        os.replace(part, path)
+        if metrics is not None:
+            metrics.observe('write', writing)
+            metrics.add_bytes(size)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return size
+
+
+class BufferedBody:
+    '''Stands in for an aiohttp response whose body is already in memory (a transformed image) in the writers'''
+
+    def __init__(self, data):
+        self.data = data
+        self.content = self
+
+    async def iter_chunked(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+def valid_jpeg(path, size=None):
+    '''Checks that path exists, has the expected size when given, and ends with the JPEG end of image marker'''
+    try:
+        actual = os.path.getsize(path)
+    except OSError:
+        return False
+    if (size is not None and actual != size) or actual < 4:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(max(actual - 32, 0))
+        # encoders may pad after the marker, so look for it near the end instead of at the last two bytes
+        return b'\xff\xd9' in f.read()
+
+
+class DirectoryStorage:
+    '''
+    The original layout, one image per page at {base_path}/Chapter {chapter}/{image_name}.ch{chapter}.p{page}.jpg
+    (or the extension of a transform.Transformer format). Chapter directories are created once per chapter,
+    not checked again for every page.
+    With a dedup.BlobStore, pages are hardlinks to its blobs and repeated images are only written once
+    '''
+    name = 'directory'
+
+    def __init__(self, base_path, image_name, manifest, dedup=None, extension='jpg'):
+        self.base_path = base_path
+        self.image_name = image_name
+        self.manifest = manifest
+        self.dedup = dedup
+        self.extension = extension
+        self.opened = set()
+        self.thumbnail_chapters = set()
+
+    def page_name(self, chapter, page):
+        return f'{self.image_name}.ch{chapter}.p{str(page).zfill(3)}.{self.extension}'
+
+    def chapter_path(self, chapter):
+        return os.path.join(self.base_path, f"Chapter {chapter}")
+
+    def photo_path(self, chapter, page):
+        '''Path of the image of page in chapter'''
+        return os.path.join(self.chapter_path(chapter), self.page_name(chapter, page))
+
+    def open_chapter(self, chapter):
+        '''Gets chapter ready for writes, returning the path it created or None'''
+        if chapter in self.opened:
+            return None
+        self.opened.add(chapter)
+        path = self.chapter_path(chapter)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            # already there, or just made by another process sharing the path
+            return None
+        return path
+
+    def stat(self, chapter, page, size=None, validate=False):
+        '''Size of the stored page, or None if it's missing (or not a complete jpeg of size, with validate)'''
+        path = self.photo_path(chapter, page)
+        if not os.path.isfile(path):
+            return None
+        if validate:
+            # only jpegs have a trailer to check, transformed images are checked by size
+            valid = valid_jpeg(path, size) if self.extension == 'jpg' else size in (None, os.path.getsize(path))
+            if not valid:
+                return None
+        return os.path.getsize(path)
+
+    async def write(self, chapter, page, response, url=None, metrics=None):
+        '''Streams response into page of chapter and records it in the manifest, returning its size'''
+        self.open_chapter(chapter)
+        if self.dedup is not None:
+            size = await self.dedup.write(response, self.photo_path(chapter, page), metrics=metrics)
+        else:
+            size = await write_stream(response, self.photo_path(chapter, page), metrics=metrics)
+        self.manifest.add_page(chapter, page, size, url)
+        return size
+
+    async def write_thumbnail(self, chapter, page, data):
+        '''Writes the thumbnail of page to {base_path}/Thumbnails/Chapter {chapter}, with the name of the page'''
+        directory = os.path.join(self.base_path, 'Thumbnails', f"Chapter {chapter}")
+        if chapter not in self.thumbnail_chapters:
+            os.makedirs(directory, exist_ok=True)
+            self.thumbnail_chapters.add(chapter)
+        await write_stream(BufferedBody(data), os.path.join(directory, self.page_name(chapter, page)))
+
+    def close(self):
+        pass
+
+
+class CBZStorage(DirectoryStorage):
+    '''
+    One zip archive per chapter at {base_path}/Chapter {chapter}.cbz, pages are stored uncompressed as they
+    complete under the same names as DirectoryStorage, so readers sort them into page order.
+    The archive is written as Chapter {chapter}.cbz.part and renamed when the chapter is complete
+    or the run ends, that's one create and one rename per chapter instead of a file per page.
+    Pages are spooled in memory (on disk past SPOOL_SIZE) while downloading,
+    then appended to the archive in a thread, one at a time per chapter
+    '''
+    name = 'cbz'
+
+    def __init__(self, base_path, image_name, manifest, dedup=None, extension='jpg'):
+        # archives have to be self contained, so pages are never shared with a dedup.BlobStore
+        super().__init__(base_path, image_name, manifest, extension=extension)
+        self.archives = {}
+        self.locks = {}
+        self.entries = {}
+        # a .part left behind by a crash has no central directory, its pages are downloaded again
+        for part in glob.glob(os.path.join(glob.escape(base_path), 'Chapter *.cbz.part')):
+            os.remove(part)
+            chapter = int(os.path.basename(part)[len('Chapter '):-len('.cbz.part')])
+            self.forget_missing(chapter)
+
+    def archive_path(self, chapter):
+        return f"{self.chapter_path(chapter)}.cbz"
+
+    def index(self, chapter):
+        '''{entry name: ZipInfo} of the archive of chapter, read once per chapter'''
+        if chapter in self.archives:
+            return {info.filename: info for info in self.archives[chapter].infolist()}
+        if chapter not in self.entries:
+            try:
+                with zipfile.ZipFile(self.archive_path(chapter)) as archive:
+                    self.entries[chapter] = {info.filename: info for info in archive.infolist()}
+            except (OSError, zipfile.BadZipFile):
+                self.entries[chapter] = {}
+        return self.entries[chapter]
+
+    def forget_missing(self, chapter):
+        '''Removes the pages of chapter the manifest has but the archive doesn't from the manifest'''
+        entries = self.index(chapter)
+        for page in list(self.manifest.done(chapter)):
+            if self.page_name(chapter, page) not in entries:
+                self.manifest.remove_page(chapter, page)
+
+    def open_chapter(self, chapter):
+        '''
+        Opens Chapter {chapter}.cbz.part for appending, returning its path.
+        An earlier, incomplete archive of the chapter is carried over, minus the pages the manifest forgot
+        '''
+        if chapter in self.archives:
+            return None
+        self.forget_missing(chapter)
+        final, part = self.archive_path(chapter), f"{self.archive_path(chapter)}.part"
+        archive = zipfile.ZipFile(part, 'w', zipfile.ZIP_STORED)
+        done = {self.page_name(chapter, page) for page in self.manifest.done(chapter)}
+        if self.index(chapter):
+            with zipfile.ZipFile(final) as previous:
+                for info in previous.infolist():
+                    if info.filename in done:
+                        done.discard(info.filename)
+                        archive.writestr(info, previous.read(info))
+        self.archives[chapter] = archive
+        self.locks[chapter] = asyncio.Lock()
+        self.entries.pop(chapter, None)
+        return part
+
+    def stat(self, chapter, page, size=None, validate=False):
+        info = self.index(chapter).get(self.page_name(chapter, page))
+        if info is None:
+            return None
+        if validate:
+            if size is not None and info.file_size != size:
+                return None
+            archive = self.archives.get(chapter)
+            try:
+                if archive is not None:
+                    data = archive.read(info)
+                else:
+                    with zipfile.ZipFile(self.archive_path(chapter)) as archive:
+                        data = archive.read(info)
+            except (OSError, ValueError, zipfile.BadZipFile):
+                return None
+            if self.extension == 'jpg' and b'\xff\xd9' not in data[-32:]:
+                return None
+        return info.file_size
+
+    async def write(self, chapter, page, response, url=None, metrics=None):
+        '''Spools response, appends it to the archive of chapter and records it in the manifest, returning its size'''
+        self.open_chapter(chapter)
+        size = 0
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                spool.write(chunk)
+                size += len(chunk)
+            spool.seek(0)
+            async with self.locks[chapter]:
+                start = perf_counter()
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.append, self.archives[chapter], self.page_name(chapter, page), spool)
+                if metrics is not None:
+                    metrics.observe('write', perf_counter() - start)
+                    metrics.add_bytes(size)
+        self.manifest.add_page(chapter, page, size, url)
+        if self.manifest.missing(chapter) == []:
+            self.close_chapter(chapter)
+        return size
+
+    @staticmethod
+    def append(archive, name, data):
+        with archive.open(zipfile.ZipInfo(name, time.localtime()[:6]), 'w') as entry:
+            shutil.copyfileobj(data, entry, CHUNK_SIZE)
+
+    def close_chapter(self, chapter):
+        '''Writes the central directory of the archive of chapter and renames it into place'''
+        archive = self.archives.pop(chapter, None)
+        if archive is None:
+            return
+        self.locks.pop(chapter, None)
+        archive.close()
+        os.replace(archive.filename, self.archive_path(chapter))
+
+    def close(self):
+        '''Closes every archive still open, incomplete chapters are carried over by the next run'''
+        for chapter in list(self.archives):
+            self.close_chapter(chapter)
+
+
+storages = {
+    'directory': DirectoryStorage,
+    'cbz': CBZStorage,
+}
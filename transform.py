@@ -0,0 +1,98 @@
+'''Optional stage between download and storage, re-encoding images (webp, avif or jpeg) with a quality,
+a max size and an optional thumbnail, in a process pool so the event loop only does I/O.
+Needs Pillow, which is only imported when a Transformer is used'''
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from PIL import Image
+import asyncio
+import io
+import os
+
+
+class TransformError(Exception):
+    '''
+    Raised when Pillow can't decode or encode an image. Retried as a parse failure, a couple of times
+    in case the body was an error page, never as a network error
+    '''
+    retry_kind = 'parse'
+
+
+# format: (Pillow format, file extension, extra save options)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'method': 4}),
+    'avif': ('AVIF', 'avif', {}),
+    'jpeg': ('JPEG', 'jpg', {'optimize': True, 'progressive': True}),
+}
+
+
+def size(text):
+    '''argparse type for WIDTHxHEIGHT'''
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def encode(image, format, quality):
+    name, _, options = FORMATS[format]
+    if image.mode not in ('RGB', 'RGBA', 'L') or (format == 'jpeg' and image.mode == 'RGBA'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, name, quality=quality, **options)
+    return buffer.getvalue()
+
+
+def transcode(data, format='webp', quality=80, max_size=None, thumbnail=None):
+    '''
+    Module level entry point, picklable for ProcessPoolExecutor. Re-encodes the image bytes data in format,
+    shrunk to fit max_size (width, height) when given. Returns (image bytes, thumbnail bytes or None)
+    '''
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if max_size:
+        image.thumbnail(max_size, Image.LANCZOS)
+    thumb = None
+    if thumbnail:
+        small = image.copy()
+        small.thumbnail(thumbnail, Image.LANCZOS)
+        thumb = encode(small, format, quality)
+    return encode(image, format, quality), thumb
+
+
+class Transformer:
+    '''
+    Runs transcode in its own pool of processes. At most twice as many images as processes are handed
+    to the pool at once, bounding memory apart from the network limiter
+    '''
+
+    def __init__(self, format='webp', quality=80, max_size=None, thumbnail=None, processes=None):
+        self.format = format
+        self.extension = FORMATS[format][1]
+        self.options = {'format': format, 'quality': quality, 'max_size': max_size, 'thumbnail': thumbnail}
+        # fail now rather than on every image when this Pillow build can't write the format
+        try:
+            encode(Image.new('RGB', (1, 1)), format, quality)
+        except (KeyError, OSError) as e:
+            raise ValueError(f"This Pillow can't encode {format}: {e!r}")
+        self.processes = processes or os.cpu_count()
+        self.pool = ProcessPoolExecutor(self.processes)
+        self.semaphore = None
+
+    async def __call__(self, data, metrics=None):
+        '''
+        Transcodes data in the pool, timed as the 'transform' stage of metrics. Returns (image, thumbnail),
+        raises TransformError when the image can't be decoded or encoded
+        '''
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.processes * 2)
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                if metrics is None:
+                    return await loop.run_in_executor(self.pool, partial(transcode, data, **self.options))
+                with metrics.time('transform'):
+                    return await loop.run_in_executor(self.pool, partial(transcode, data, **self.options))
+            # UnidentifiedImageError and truncated images are OSErrors, which would be retried as network errors
+            except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+                raise TransformError(f"Can't transform the {len(data)} byte image: {e!r}") from e
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,125 @@
+'''Daemon mode. A Watcher keeps one MangaClient (session, caches, limiter) alive and polls the end chapter
+of every tracked series on a jittered schedule, running the download pipeline only over the chapters
+that showed up since the last poll. Downloads run in the background, so a long backfill of one series
+doesn't hold back the polls of the others. Failed polls back off exponentially.
+/health and /status report on it over http, next to the prometheus metrics'''
+from time import time
+import asyncio
+import json
+import random
+
+
+class Watcher:
+    '''
+    Polls each series every interval seconds, +- jitter as a fraction of interval so series don't poll in lockstep.
+    After a failed poll the series waits interval * 2 ** failures instead, up to max_backoff.
+    A series isn't polled while its chapters are downloading, the batches of different polls share the client
+    (and its limiter) but each has its own pipeline
+    '''
+
+    def __init__(self, client, series, interval=3600, jitter=0.1, max_backoff=24 * 3600):
+        self.client = client
+        self.series = series
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.started = time()
+        self.downloads = set()
+        self.finished = asyncio.Event()
+        self.status = {entry.directory: {'state': 'waiting', 'next_poll': time(), 'last_poll': None, 'latest': None,
+                                         'pending': [], 'failures': 0, 'last_error': None, 'downloaded_pages': 0}
+                       for entry in series}
+
+    def delay(self, failures):
+        delay = min(self.max_backoff, self.interval * 2 ** failures)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def run(self):
+        '''Polls the series as they come due, forever'''
+        # polls go through the shared session and its kept alive connections, not one shot urllib requests
+        self.client.sessions.session()
+        try:
+            while True:
+                now = time()
+                idle = [entry for entry in self.series if self.status[entry.directory]['state'] != 'downloading']
+                due = [entry for entry in idle if self.status[entry.directory]['next_poll'] <= now]
+                if due:
+                    await self.poll(due)
+                    continue
+                # until the next idle series is due, or a download finishes and its series can be polled again
+                next_poll = min((self.status[entry.directory]['next_poll'] for entry in idle), default=now + self.interval)
+                self.finished.clear()
+                try:
+                    await asyncio.wait_for(self.finished.wait(), next_poll - now)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            downloads = list(self.downloads)
+            for download in downloads:
+                download.cancel()
+            await asyncio.gather(*downloads, return_exceptions=True)
+
+    async def poll(self, due):
+        '''Checks every due series at once, then starts downloading the new chapters of all of them in the background'''
+        results = await asyncio.gather(*(self.check(entry) for entry in due), return_exceptions=True)
+        jobs = []
+        for entry, result in zip(due, results):
+            status = self.status[entry.directory]
+            status['last_poll'] = time()
+            if isinstance(result, Exception):
+                status['failures'] += 1
+                status['last_error'] = repr(result)
+                status['state'] = 'backing off'
+                print(f"{entry.directory}: poll failed ({status['failures']} in a row): {result!r}")
+            else:
+                status['failures'] = 0
+                status['latest'], status['pending'] = result
+                jobs += [(entry, chapter) for chapter in status['pending']]
+            status['next_poll'] = time() + self.delay(status['failures'])
+        if not jobs:
+            return
+        downloading = {entry for entry, _ in jobs}
+        for entry in downloading:
+            print(f"{entry.directory}: downloading chapters {self.status[entry.directory]['pending']}")
+            self.status[entry.directory]['state'] = 'downloading'
+        download = asyncio.ensure_future(self.download(downloading, jobs))
+        self.downloads.add(download)
+        download.add_done_callback(self.downloads.discard)
+
+    async def download(self, downloading, jobs):
+        '''Runs the pipeline over jobs, then lets the series in downloading be polled again'''
+        pages = {entry: entry.runtime_pages for entry in downloading}
+        try:
+            await self.client.run_pipeline(jobs)
+        except Exception as e:
+            print(f"{', '.join(entry.directory for entry in downloading)}: download failed: {e!r}")
+        finally:
+            for entry in downloading:
+                status = self.status[entry.directory]
+                status['downloaded_pages'] += entry.runtime_pages - pages[entry]
+                status['pending'] = []
+                status['state'] = 'waiting'
+                # the next poll only looks at chapters from here on
+                entry.initial = entry.last_chapter
+            self.finished.set()
+
+    async def check(self, entry):
+        '''(latest chapter, chapters to download) of entry'''
+        self.status[entry.directory]['state'] = 'polling'
+        latest = await self.client.end_chapter(entry)
+        pending = await self.client.pending_chapters(entry, latest)
+        self.status[entry.directory]['state'] = 'waiting'
+        return latest, pending
+
+    def health(self):
+        '''503 when every series is failing its polls'''
+        failing = all(status['failures'] for status in self.status.values())
+        return (503 if failing else 200), 'text/plain', 'failing\n' if failing else 'ok\n'
+
+    def snapshot(self):
+        return {'uptime': round(time() - self.started, 1), 'series': self.status, 'metrics': self.client.metrics.snapshot()}
+
+    def routes(self):
+        '''Routes for Metrics.serve: /health, /status as json, anything else is the prometheus metrics'''
+        return {'/health': self.health,
+                '/status': lambda: (200, 'application/json', json.dumps(self.snapshot(), indent=2) + '\n')}